@@ -7,9 +7,19 @@ import shutil
 from tqdm import tqdm
 from osgeo import gdal, ogr, osr
 
+from utils.contours import (
+    ContourOutputs,
+    ContourStitcher,
+    make_line,
+    make_windows,
+    trace_contours,
+)
+
 # supress gdal exceptions
 gdal.UseExceptions()
 
+VRT_FILE = "data/temp/elevation-feet.vrt"
+
 
 @click.command()
 @click.option(
@@ -18,7 +28,12 @@ gdal.UseExceptions()
 @click.option(
     "--workers", default=multiprocessing.cpu_count(), help="Number of workers to use"
 )
-def cli(workers, input_files):
+@click.option(
+    "--window-size",
+    default=4096,
+    help="Width and height in pixels of the windows contours are generated in",
+)
+def cli(workers, input_files, window_size):
     files = glob.glob(input_files)
 
     # create a data/temp/ directory if it doesn't exist
@@ -41,39 +56,89 @@ def cli(workers, input_files):
     )
 
     ds = gdal.Open("data/temp/elevation.vrt")
-    gdal.Translate("data/temp/elevation-feet.vrt", ds, options=translate_options)
-
+    vds = gdal.Translate(VRT_FILE, ds, options=translate_options)
+    geotransform = vds.GetGeoTransform()
+    width, height = vds.RasterXSize, vds.RasterYSize
+    vds = None
+
+    # contours are traced once at the finest interval, and each line is written
+    # to the file of the coarsest interval it falls on, so the files don't
+    # overlap. every interval must be a multiple of the first
     intervals = [40, 200, 1000]
 
-    with multiprocessing.Pool(processes=workers) as pool:
-        for _ in tqdm(
-            pool.imap_unordered(create_contours, intervals), total=len(intervals)
-        ):
-            pass
+    # split the dem into overlapping windows and contour them in parallel
+    windows = make_windows(width, height, window_size)
+    tasks = [
+        (intervals[0], window, core, geotransform, width, height)
+        for window, core in windows
+    ]
+    print("Generating contours in", len(windows), "windows with", workers, "workers")
 
-
-def create_contours(interval):
-    vds = gdal.Open("data/temp/elevation-feet.vrt")
     sr = osr.SpatialReference()
     sr.ImportFromEPSG(4326)
+    outputs = ContourOutputs(intervals, sr)
 
-    # save output as GPKG
-    out_dataset = ogr.GetDriverByName("GPKG").CreateDataSource(
-        f"data/temp/contour_{interval}.gpkg",
-    )
+    # contours cut by a window seam are joined back together once every window
+    # is done, matching their ends to within a thousandth of a pixel
+    stitcher = ContourStitcher(abs(geotransform[1]) / 1000)
 
-    contour_layer = out_dataset.CreateLayer("elevation", sr)
-    contour_layer.CreateField(ogr.FieldDefn("ID", ogr.OFTInteger))
-    contour_layer.CreateField(ogr.FieldDefn("elevation", ogr.OFTReal))
+    with multiprocessing.Pool(processes=workers) as pool:
+        for _, lines, seam_lines in tqdm(
+            pool.imap_unordered(create_contours, tasks), total=len(tasks)
+        ):
+            outputs.write(
+                (elevation, ogr.CreateGeometryFromWkb(wkb)) for elevation, wkb in lines
+            )
+            for elevation, coords in seam_lines:
+                stitcher.add(elevation, coords)
+
+    print("Stitching contours across window seams...")
+    outputs.write(
+        (elevation, make_line(coords)) for elevation, coords in stitcher.lines()
+    )
+    outputs.close()
+
+
+def create_contours(task):
+    interval, window, core, geotransform, width, height = task
+    xoff, yoff, xsize, ysize = window
+    col0, row0, col1, row1 = core
+
+    # copy the window into memory and contour it
+    vds = gdal.Open(VRT_FILE)
+    window_ds = gdal.Translate("", vds, format="MEM", srcWin=[xoff, yoff, xsize, ysize])
+    vds = None
+
+    # the window's core in map coordinates. seams are the core edges that are
+    # shared with another window rather than the edge of the dem
+    x0 = geotransform[0] + col0 * geotransform[1]
+    x1 = geotransform[0] + col1 * geotransform[1]
+    y0 = geotransform[3] + row0 * geotransform[5]
+    y1 = geotransform[3] + row1 * geotransform[5]
+
+    seams = []
+    if col0 > 0:
+        seams.append((0, x0))
+    if col1 < width:
+        seams.append((0, x1))
+    if row0 > 0:
+        seams.append((1, y0))
+    if row1 < height:
+        seams.append((1, y1))
 
-    # create the contours
     try:
-        gdal.ContourGenerate(
-            vds.GetRasterBand(1), interval, 0, [], 0, 0, contour_layer, 0, 1
+        lines, seam_lines = trace_contours(
+            window_ds.GetRasterBand(1),
+            interval,
+            (x0, y0, x1, y1),
+            seams,
+            abs(geotransform[1]) / 1000,
         )
     except:
-        print(f"error generating contours for {interval}")
-        pass
+        print(f"error generating contours for {interval} in window {window}")
+        return interval, [], []
+
+    return interval, lines, seam_lines
 
 
 if __name__ == "__main__":
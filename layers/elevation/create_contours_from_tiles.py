@@ -0,0 +1,220 @@
+import multiprocessing
+import os
+import click
+
+import mercantile
+import numpy as np
+
+from tqdm import tqdm
+from osgeo import gdal, ogr, osr
+
+from utils.contours import (
+    WINDOW_OVERLAP,
+    ContourOutputs,
+    ContourStitcher,
+    make_line,
+    trace_contours,
+)
+from utils.terrain_rgb import TILE_SIZE, decode_image, rgb_to_data
+from utils.tiler import open_reader
+
+gdal.UseExceptions()
+
+NODATA = -99999
+# the elevation the tiler encodes the DEM's nodata pixels as
+TILE_NODATA = -9999
+UNIT_SCALES = {"feet": 1 / 0.3048, "meters": 1.0}
+
+# per-worker globals, set by _init_worker
+reader = None
+global_args = None
+to_wgs84 = None
+
+
+def make_transform():
+    web_mercator = osr.SpatialReference()
+    web_mercator.ImportFromEPSG(3857)
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(web_mercator, wgs84)
+
+
+def _init_worker(input_file, args):
+    global reader, global_args, to_wgs84
+    reader = open_reader(input_file)
+    global_args = args
+    to_wgs84 = make_transform()
+
+
+def read_elevation(x, y, z):
+    if not (0 <= x < (1 << z) and 0 <= y < (1 << z)):
+        return None
+    contents = reader.get_tile(x, y, z)
+    if contents is None:
+        return None
+    rgb = decode_image(contents)
+    elevation = rgb_to_data(rgb, global_args["base_val"], global_args["interval"])
+    # tiles along the edge of the DEM and over holes in it have nodata pixels,
+    # which would otherwise be contoured as a cliff down to -9999 m
+    missing = np.abs(elevation - TILE_NODATA) < global_args["interval"] / 2
+    elevation = (elevation * global_args["unit_scale"]).astype(np.float32)
+    elevation[missing] = NODATA
+    return elevation
+
+
+def contour_block(block):
+    # contour a block of block_size x block_size tiles, with a halo of pixels
+    # from the tiles around it so the lines cross the block edges the same way
+    # the neighbouring blocks see them
+    bx, by, z = block
+    size = global_args["block_size"]
+    halo = WINDOW_OVERLAP
+    x_start, y_start = bx * size, by * size
+
+    pixels = size * TILE_SIZE
+    mosaic = np.full((pixels + 2 * halo, pixels + 2 * halo), NODATA, dtype=np.float32)
+    for y in range(y_start - 1, y_start + size + 1):
+        for x in range(x_start - 1, x_start + size + 1):
+            elevation = read_elevation(x, y, z)
+            if elevation is None:
+                continue
+
+            # where the tile lands in the mosaic, clipped to the halo
+            row = (y - y_start) * TILE_SIZE + halo
+            col = (x - x_start) * TILE_SIZE + halo
+            row0, col0 = max(row, 0), max(col, 0)
+            row1 = min(row + TILE_SIZE, mosaic.shape[0])
+            col1 = min(col + TILE_SIZE, mosaic.shape[1])
+            if row1 <= row0 or col1 <= col0:
+                continue
+            mosaic[row0:row1, col0:col1] = elevation[
+                row0 - row : row1 - row, col0 - col : col1 - col
+            ]
+
+    if (mosaic == NODATA).all():
+        return [], []
+
+    # the block's core is the extent of its tiles, in web mercator
+    left, top = mercantile.xy(*mercantile.ul(x_start, y_start, z))
+    right, bottom = mercantile.xy(*mercantile.ul(x_start + size, y_start + size, z))
+    pixel_size = (right - left) / pixels
+
+    block_ds = gdal.GetDriverByName("MEM").Create(
+        "", mosaic.shape[1], mosaic.shape[0], 1, gdal.GDT_Float32
+    )
+    block_ds.SetGeoTransform(
+        [
+            left - halo * pixel_size,
+            pixel_size,
+            0,
+            top + halo * pixel_size,
+            0,
+            -pixel_size,
+        ]
+    )
+    band = block_ds.GetRasterBand(1)
+    band.WriteArray(mosaic)
+    band.SetNoDataValue(NODATA)
+
+    # every block edge may be shared with another block
+    seams = [(0, left), (0, right), (1, top), (1, bottom)]
+    return trace_contours(
+        band,
+        global_args["contour_interval"],
+        (left, top, right, bottom),
+        seams,
+        pixel_size / 1000,
+        nodata=NODATA,
+        transform=to_wgs84,
+    )
+
+
+@click.command()
+@click.option(
+    "--input-file",
+    default="data/output/elevation.pmtiles",
+    help="TerrainRGB .pmtiles or .mbtiles file to contour",
+)
+@click.option(
+    "--workers", default=multiprocessing.cpu_count(), help="Number of workers to use"
+)
+@click.option(
+    "--zoom",
+    type=int,
+    default=None,
+    help="Zoom level of the tiles to contour, defaults to the highest in the file",
+)
+@click.option(
+    "--intervals",
+    default="40,200,1000",
+    help="Comma separated contour intervals, each a multiple of the first",
+)
+@click.option(
+    "--units",
+    type=click.Choice(list(UNIT_SCALES)),
+    default="feet",
+    help="Units of the contour elevations",
+)
+@click.option(
+    "--block-size",
+    default=8,
+    help="Width and height in tiles of the blocks each worker contours at once",
+)
+@click.option(
+    "--output-dir", default="data/temp", help="Directory to write the contours to"
+)
+def cli(input_file, workers, zoom, intervals, units, block_size, output_dir):
+    intervals = [int(interval) for interval in intervals.split(",")]
+    os.makedirs(output_dir, exist_ok=True)
+
+    tiles_reader = open_reader(input_file)
+    if zoom is None:
+        zoom = tiles_reader.max_z
+    blocks = sorted(
+        {(x // block_size, y // block_size, z) for x, y, z in tiles_reader.tiles(zoom)}
+    )
+    tiles_reader.close()
+
+    print("Contouring", input_file, "at zoom", zoom, "in", len(blocks), "blocks")
+
+    args = {
+        "base_val": -10000,
+        "interval": 0.1,
+        "unit_scale": UNIT_SCALES[units],
+        "contour_interval": intervals[0],
+        "block_size": block_size,
+    }
+
+    sr = osr.SpatialReference()
+    sr.ImportFromEPSG(4326)
+    outputs = ContourOutputs(intervals, sr, output_dir)
+
+    # lines cut at block edges are stitched in web mercator, to within a
+    # thousandth of a pixel, before being reprojected
+    pixel_size = mercantile.CE / ((1 << zoom) * TILE_SIZE)
+    stitcher = ContourStitcher(pixel_size / 1000)
+
+    with multiprocessing.Pool(
+        workers, initializer=_init_worker, initargs=(input_file, args)
+    ) as pool:
+        for lines, seam_lines in tqdm(
+            pool.imap_unordered(contour_block, blocks), total=len(blocks)
+        ):
+            outputs.write(
+                (elevation, ogr.CreateGeometryFromWkb(wkb)) for elevation, wkb in lines
+            )
+            for elevation, coords in seam_lines:
+                stitcher.add(elevation, coords)
+
+    print("Stitching contours across block edges...")
+    transform = make_transform()
+    outputs.write(
+        (elevation, make_line(coords, transform))
+        for elevation, coords in stitcher.lines()
+    )
+    outputs.close()
+
+
+if __name__ == "__main__":
+    cli()
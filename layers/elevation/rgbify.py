@@ -1,16 +1,7 @@
 import click
 import multiprocessing
-import rio_rgbify.mbtiler as mbtiler
-from rasterio.warp import transform_bounds
 
-
-def fixed_transform_bounds(*args, **kwargs):
-    if "densify_pts" in kwargs:
-        kwargs["densify_pts"] = 2
-    return transform_bounds(*args, **kwargs)
-
-
-mbtiler.transform_bounds = fixed_transform_bounds
+from utils.tiler import RGBTiler
 
 
 # click cli to get number of workers and bounding box
@@ -19,20 +10,36 @@ mbtiler.transform_bounds = fixed_transform_bounds
     "--workers", default=multiprocessing.cpu_count(), help="Number of workers to use"
 )
 @click.option("--input-dataset", help="Dataset to convert")
-@click.option("--output-mbtiles", help="Output mbtiles file")
+@click.option(
+    "--output-file",
+    "--output-mbtiles",
+    help="Output .pmtiles or .mbtiles file",
+)
 @click.option("--min-z", default=1)
 @click.option("--max-z", default=14)
-def cli(workers, input_dataset, output_mbtiles, min_z, max_z):
+@click.option(
+    "--max-memory",
+    default=4096,
+    help="Approximate memory budget in MB, shared between the workers and the tile writer",
+)
+@click.option(
+    "--pyramid",
+    is_flag=True,
+    default=False,
+    help="Only read the sources at max-z and build lower zooms from the tiles below them",
+)
+def cli(workers, input_dataset, output_file, min_z, max_z, max_memory, pyramid):
     print("Running with", workers, "workers")
-    print("Converting", input_dataset, "to", output_mbtiles)
-    with mbtiler.RGBTiler(
+    print("Converting", input_dataset, "to", output_file)
+    with RGBTiler(
         input_dataset,
-        output_mbtiles,
+        output_file,
         interval=0.1,
         base_val=-10000,
-        format="webp",
         max_z=max_z,
         min_z=min_z,
+        max_memory=max_memory,
+        pyramid=pyramid,
     ) as tiler:
         tiler.run(workers)
 
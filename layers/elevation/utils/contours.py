@@ -0,0 +1,240 @@
+from osgeo import gdal, ogr
+
+# windows are read this many pixels past each seam, so the contours on both sides
+# of a seam are traced from the same pixels and cross it at the same points
+WINDOW_OVERLAP = 2
+
+
+def make_windows(width, height, size):
+    # split a raster into windows of about size x size pixels. each window is
+    # (xoff, yoff, xsize, ysize) to read, plus the core (col0, row0, col1, row1)
+    # whose contours it keeps. the cores tile the raster and meet at pixel edges,
+    # which contour vertices never lie on
+    windows = []
+    for row0 in range(0, height, size):
+        for col0 in range(0, width, size):
+            col1 = min(col0 + size, width)
+            row1 = min(row0 + size, height)
+            xoff = max(col0 - WINDOW_OVERLAP, 0)
+            yoff = max(row0 - WINDOW_OVERLAP, 0)
+            xend = min(col1 + WINDOW_OVERLAP, width)
+            yend = min(row1 + WINDOW_OVERLAP, height)
+            windows.append(
+                ((xoff, yoff, xend - xoff, yend - yoff), (col0, row0, col1, row1))
+            )
+    return windows
+
+
+class ContourStitcher:
+    # joins contour fragments cut at window seams back into single lines by
+    # matching their endpoints and elevations
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.fragments = []
+        self.ends = {}
+
+    def _key(self, elevation, point):
+        return (
+            elevation,
+            round(point[0] / self.tolerance),
+            round(point[1] / self.tolerance),
+        )
+
+    def _matches(self, a, b):
+        return (
+            abs(a[0] - b[0]) <= self.tolerance * 1.5
+            and abs(a[1] - b[1]) <= self.tolerance * 1.5
+        )
+
+    def add(self, elevation, coords):
+        index = len(self.fragments)
+        self.fragments.append((elevation, coords))
+        for point in (coords[0], coords[-1]):
+            self.ends.setdefault(self._key(elevation, point), []).append(index)
+
+    def _find(self, elevation, point, used):
+        # look in the neighbouring cells too, in case rounding put the two ends
+        # of a seam crossing on either side of a cell boundary
+        _, qx, qy = self._key(elevation, point)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for index in self.ends.get((elevation, qx + dx, qy + dy), []):
+                    if index in used:
+                        continue
+                    coords = self.fragments[index][1]
+                    if self._matches(coords[0], point) or self._matches(
+                        coords[-1], point
+                    ):
+                        return index
+        return None
+
+    def lines(self):
+        used = set()
+        for index, (elevation, coords) in enumerate(self.fragments):
+            if index in used:
+                continue
+            used.add(index)
+            line = list(coords)
+
+            # extend the line forwards from its end
+            while (match := self._find(elevation, line[-1], used)) is not None:
+                used.add(match)
+                other = self.fragments[match][1]
+                if not self._matches(other[0], line[-1]):
+                    other = other[::-1]
+                line.extend(other[1:])
+
+            # then backwards from its start
+            while (match := self._find(elevation, line[0], used)) is not None:
+                used.add(match)
+                other = self.fragments[match][1]
+                if not self._matches(other[-1], line[0]):
+                    other = other[::-1]
+                line[:0] = other[:-1]
+
+            if len(line) > 2 and self._matches(line[0], line[-1]):
+                # close rings that were cut by a seam
+                line[-1] = line[0]
+
+            yield elevation, line
+
+
+def contour_class(elevation, intervals):
+    # the coarsest of the intervals that a contour at this elevation falls on
+    for interval in sorted(intervals, reverse=True):
+        if elevation % interval == 0:
+            return interval
+    return min(intervals)
+
+
+class ContourWriter:
+    # writes contour lines to a GeoPackage layer named "elevation"
+    def __init__(self, output_file, sr):
+        self.dataset = ogr.GetDriverByName("GPKG").CreateDataSource(output_file)
+        self.layer = self.dataset.CreateLayer("elevation", sr)
+        self.layer.CreateField(ogr.FieldDefn("ID", ogr.OFTInteger))
+        self.layer.CreateField(ogr.FieldDefn("elevation", ogr.OFTReal))
+        self.count = 0
+
+    def write(self, lines):
+        # write a batch of lines in one transaction
+        self.layer.StartTransaction()
+        for elevation, geometry in lines:
+            feature = ogr.Feature(self.layer.GetLayerDefn())
+            feature.SetField("ID", self.count)
+            feature.SetField("elevation", elevation)
+            feature.SetGeometry(geometry)
+            self.layer.CreateFeature(feature)
+            self.count += 1
+        self.layer.CommitTransaction()
+
+    def close(self):
+        self.layer = None
+        self.dataset = None
+
+
+class ContourOutputs:
+    # writes each line to {output_dir}/contour_{interval}.gpkg for the coarsest
+    # interval it falls on, so the files don't overlap
+    def __init__(self, intervals, sr, output_dir="data/temp"):
+        self.intervals = intervals
+        self.writers = {
+            interval: ContourWriter(f"{output_dir}/contour_{interval}.gpkg", sr)
+            for interval in intervals
+        }
+
+    def write(self, lines):
+        classified = {interval: [] for interval in self.intervals}
+        for elevation, geometry in lines:
+            classified[contour_class(elevation, self.intervals)].append(
+                (elevation, geometry)
+            )
+        for interval, interval_lines in classified.items():
+            self.writers[interval].write(interval_lines)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+def make_line(coords, transform=None):
+    line = ogr.Geometry(ogr.wkbLineString)
+    for x, y in coords:
+        line.AddPoint_2D(x, y)
+    if transform is not None:
+        line.Transform(transform)
+    return line
+
+
+def iter_lines(geometry):
+    # clipping can return multilinestrings, or points where a line just touches
+    # the edge of the core; only keep the line parts
+    if geometry is None or geometry.IsEmpty():
+        return
+    if geometry.GetGeometryType() in (ogr.wkbLineString, ogr.wkbLineString25D):
+        if geometry.GetPointCount() > 1:
+            yield geometry
+        return
+    for i in range(geometry.GetGeometryCount()):
+        yield from iter_lines(geometry.GetGeometryRef(i))
+
+
+def trace_contours(band, interval, core, seams, tolerance, nodata=None, transform=None):
+    # contour a window's band and clip the lines to the window's core, given as
+    # (x0, y0, x1, y1) in map coordinates. returns the lines that are complete
+    # as (elevation, wkb), reprojected with transform if given, and the lines
+    # ending on one of the seams, (axis, value) edges of the core shared with
+    # another window, as (elevation, coords) to be stitched
+    mem_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+    contour_layer = mem_ds.CreateLayer("elevation")
+    contour_layer.CreateField(ogr.FieldDefn("ID", ogr.OFTInteger))
+    contour_layer.CreateField(ogr.FieldDefn("elevation", ogr.OFTReal))
+
+    gdal.ContourGenerate(
+        band,
+        interval,
+        0,
+        [],
+        0 if nodata is None else 1,
+        0 if nodata is None else nodata,
+        contour_layer,
+        0,
+        1,
+    )
+
+    x0, y0, x1, y1 = core
+    min_x, max_x = min(x0, x1), max(x0, x1)
+    min_y, max_y = min(y0, y1), max(y0, y1)
+    core_polygon = ogr.CreateGeometryFromWkt(
+        f"POLYGON(({x0} {y0}, {x1} {y0}, {x1} {y1}, {x0} {y1}, {x0} {y0}))"
+    )
+
+    def on_seam(point):
+        return any(abs(point[axis] - value) < tolerance for axis, value in seams)
+
+    lines = []
+    seam_lines = []
+    for feature in contour_layer:
+        elevation = feature.GetField("elevation")
+        geometry = feature.GetGeometryRef()
+
+        # clip lines that leave the core; the neighbouring window keeps the rest
+        env_min_x, env_max_x, env_min_y, env_max_y = geometry.GetEnvelope()
+        if (
+            env_min_x < min_x
+            or env_max_x > max_x
+            or env_min_y < min_y
+            or env_max_y > max_y
+        ):
+            geometry = geometry.Intersection(core_polygon)
+
+        for line in iter_lines(geometry):
+            points = line.GetPoints()
+            if on_seam(points[0]) or on_seam(points[-1]):
+                seam_lines.append((elevation, [point[:2] for point in points]))
+            else:
+                if transform is not None:
+                    line.Transform(transform)
+                lines.append((elevation, line.ExportToWkb()))
+
+    return lines, seam_lines
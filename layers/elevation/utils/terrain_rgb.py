@@ -0,0 +1,61 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+TILE_SIZE = 512
+
+
+def data_to_rgb(data, base_val, interval):
+    # encode elevation values as mapbox TerrainRGB, matching rio-rgbify's encoder
+    data = data.astype(np.float64)
+    data -= base_val
+    data /= interval
+
+    rows, cols = data.shape
+    rgb = np.zeros((3, rows, cols), dtype=np.uint8)
+    rgb[2] = ((data / 256) - (data // 256)) * 256
+    rgb[1] = (((data // 256) / 256) - ((data // 256) // 256)) * 256
+    rgb[0] = ((((data // 256) // 256) / 256) - (((data // 256) // 256) // 256)) * 256
+    return rgb
+
+
+def rgb_to_data(rgb, base_val, interval):
+    # decode TerrainRGB back to elevation values
+    rgb = rgb.astype(np.float64)
+    return base_val + (rgb[0] * 256 * 256 + rgb[1] * 256 + rgb[2]) * interval
+
+
+def decode_image(contents):
+    # decode an encoded tile to a (3, rows, cols) rgb array
+    with BytesIO(contents) as f:
+        im = Image.open(f).convert("RGB")
+        return np.rollaxis(np.asarray(im), 2, 0)
+
+
+def encode_webp(rgb):
+    with BytesIO() as f:
+        im = Image.fromarray(np.rollaxis(rgb, 0, 3))
+        im.save(f, format="webp", lossless=True)
+        return f.getvalue()
+
+
+def downsample(children, nodata):
+    # average the four child tiles (nw, ne, sw, se) of a tile into a tile of the
+    # same size, ignoring nodata pixels. missing children count as nodata
+    mosaic = np.full((TILE_SIZE * 2, TILE_SIZE * 2), np.nan, dtype=np.float32)
+    for i, child in enumerate(children):
+        if child is None:
+            continue
+        row, col = (i // 2) * TILE_SIZE, (i % 2) * TILE_SIZE
+        mosaic[row : row + TILE_SIZE, col : col + TILE_SIZE] = child
+    mosaic[mosaic == nodata] = np.nan
+
+    valid = ~np.isnan(mosaic)
+    blocks = np.where(valid, mosaic, 0).reshape(TILE_SIZE, 2, TILE_SIZE, 2)
+    sums = blocks.sum(axis=(1, 3))
+    counts = valid.reshape(TILE_SIZE, 2, TILE_SIZE, 2).sum(axis=(1, 3))
+
+    out = np.full((TILE_SIZE, TILE_SIZE), nodata, dtype=np.float32)
+    np.divide(sums, counts, out=out, where=counts > 0)
+    return out
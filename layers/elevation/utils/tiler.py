@@ -0,0 +1,549 @@
+import itertools
+import math
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import mercantile
+import numpy as np
+import rasterio
+
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.warp import reproject, transform_bounds
+from rasterio.windows import Window
+from rasterio.windows import from_bounds as window_from_bounds
+from tqdm import tqdm
+
+from utils.terrain_rgb import TILE_SIZE, data_to_rgb, downsample, encode_webp
+
+current_dir = os.path.dirname(__file__)
+sys.path.append(os.path.join(current_dir, "..", "..", "..", "utils"))
+
+import pmtiles_archive
+
+# memory a worker needs besides its GDAL block cache: the source window (read at
+# no more than twice the tile resolution), the warped tile and the encoded output
+WORKER_OVERHEAD = 64 * 1024 * 1024
+MIN_CACHE_BYTES = 16 * 1024 * 1024
+# worst case size of an encoded tile waiting to be written
+MAX_TILE_BYTES = TILE_SIZE * TILE_SIZE * 3
+# extra source pixels read around each tile so bilinear resampling at the tile
+# edges sees the same neighbours as a warp over the whole dataset
+WINDOW_PADDING = 2
+# in pyramid mode each worker task renders a tile's descendants this many zoom
+# levels down from the sources and builds the levels in between from them
+PYRAMID_DEPTH = 3
+
+# per-worker globals, set by _init_worker
+src = None
+env = None
+global_args = None
+# encoded tiles with a single elevation value, which are common (nodata, sea
+# level) and always encode to the same bytes
+flat_tiles = {}
+
+
+def plan_memory(max_memory, workers):
+    # split the memory budget (in MB) between the workers' GDAL caches and the
+    # queue of encoded tiles waiting to be written
+    budget = max_memory * 1024 * 1024
+    worker_budget = budget * 3 // 4
+
+    max_workers = max(1, worker_budget // (WORKER_OVERHEAD + MIN_CACHE_BYTES))
+    if workers > max_workers:
+        print(
+            f"Reducing workers from {workers} to {max_workers} to stay within {max_memory} MB"
+        )
+        workers = max_workers
+
+    cache_bytes = max(MIN_CACHE_BYTES, worker_budget // workers - WORKER_OVERHEAD)
+    max_in_flight = max(workers, (budget - worker_budget) // MAX_TILE_BYTES)
+    return workers, cache_bytes, max_in_flight
+
+
+def _init_worker(input_dataset, args):
+    global src, env, global_args
+    env = rasterio.Env(GDAL_CACHEMAX=args["cache_bytes"])
+    env.__enter__()
+    src = rasterio.open(input_dataset)
+    global_args = args
+
+
+def _source_window(bounds):
+    # find the window of the source dataset covering the tile bounds
+    left, bottom, right, top = transform_bounds("EPSG:3857", src.crs, *bounds)
+    window = window_from_bounds(left, bottom, right, top, transform=src.transform)
+
+    # at low zooms a tile spans far more source pixels than it has, so read the
+    # window decimated to at most twice the tile resolution
+    scale = max(1.0, max(window.width, window.height) / (2 * TILE_SIZE))
+    padding = math.ceil(WINDOW_PADDING * scale)
+
+    col_off = max(math.floor(window.col_off) - padding, 0)
+    row_off = max(math.floor(window.row_off) - padding, 0)
+    col_end = min(math.ceil(window.col_off + window.width) + padding, src.width)
+    row_end = min(math.ceil(window.row_off + window.height) + padding, src.height)
+
+    if col_end <= col_off or row_end <= row_off:
+        return None, scale
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off), scale
+
+
+def read_tile(x, y, z):
+    bounds = [
+        *mercantile.xy(*mercantile.ul(x, y + 1, z)),
+        *mercantile.xy(*mercantile.ul(x + 1, y, z)),
+    ]
+    dst_transform = from_bounds(*bounds, TILE_SIZE, TILE_SIZE)
+    nodata = src.nodata if src.nodata is not None else 0
+    out = np.full((TILE_SIZE, TILE_SIZE), nodata, dtype=src.dtypes[0])
+
+    window, scale = _source_window(bounds)
+    if window is None:
+        # the tile is outside the source dataset
+        return out
+
+    if scale == 1.0:
+        # at native resolution GDAL's warper only reads the source blocks under
+        # the tile, so warp straight from the band
+        reproject(
+            rasterio.band(src, 1),
+            out,
+            dst_transform=dst_transform,
+            dst_crs="EPSG:3857",
+            dst_nodata=src.nodata,
+            resampling=Resampling.bilinear,
+        )
+        return out
+
+    out_shape = (
+        max(1, math.ceil(window.height / scale)),
+        max(1, math.ceil(window.width / scale)),
+    )
+    data = src.read(
+        1, window=window, out_shape=out_shape, resampling=Resampling.average
+    )
+    src_transform = src.window_transform(window) * Affine.scale(
+        window.width / out_shape[1], window.height / out_shape[0]
+    )
+
+    reproject(
+        data,
+        out,
+        src_transform=src_transform,
+        src_crs=src.crs,
+        src_nodata=src.nodata,
+        dst_transform=dst_transform,
+        dst_crs="EPSG:3857",
+        dst_nodata=src.nodata,
+        resampling=Resampling.bilinear,
+    )
+    return out
+
+
+def encode_tile(elevation):
+    value = elevation.flat[0]
+    flat = (elevation == value).all()
+    if flat and value in flat_tiles:
+        return flat_tiles[value]
+
+    rgb = data_to_rgb(elevation, global_args["base_val"], global_args["interval"])
+    contents = encode_webp(rgb)
+    if flat:
+        flat_tiles[value] = contents
+    return contents
+
+
+def _tile_worker(tile):
+    x, y, z = tile
+    return tile, encode_tile(read_tile(x, y, z))
+
+
+def _encode_worker(task):
+    tile, elevation = task
+    return tile, encode_tile(elevation)
+
+
+def child_tiles(tile):
+    # the four children of a tile, ordered nw, ne, sw, se
+    x, y, z = tile
+    return [(x * 2 + dx, y * 2 + dy, z + 1) for dy in (0, 1) for dx in (0, 1)]
+
+
+def in_range(tile, ranges):
+    x, y, z = tile
+    xs, ys = ranges[z]
+    return x in xs and y in ys
+
+
+def _build_subtree(tile, encoded):
+    # render the max zoom descendants of a tile from the sources, then build each
+    # level above them by downsampling the four children
+    x, y, z = tile
+    if z == global_args["max_z"]:
+        elevation = read_tile(x, y, z)
+    else:
+        children = [
+            (
+                _build_subtree(child, encoded)
+                if in_range(child, global_args["ranges"])
+                else None
+            )
+            for child in child_tiles(tile)
+        ]
+        elevation = downsample(children, global_args["nodata"])
+
+    encoded.append((tile, encode_tile(elevation)))
+    return elevation
+
+
+def _subtree_worker(tile):
+    encoded = []
+    elevation = _build_subtree(tile, encoded)
+    # the tiles of each level of a subtree are a contiguous run of tile ids, so
+    # sorting them keeps every level in tile id order
+    encoded.sort(
+        key=lambda item: pmtiles_archive.zxy_to_tileid(
+            item[0][2], item[0][0], item[0][1]
+        )
+    )
+    return tile, elevation, encoded
+
+
+def tile_ranges(bounds, min_z, max_z):
+    # the range of tiles covering lng/lat bounds at each zoom level
+    w, s, e, n = bounds
+    EPSILON = 1.0e-10
+    w += EPSILON
+    s += EPSILON
+    e -= EPSILON
+    n -= EPSILON
+
+    for z in range(min_z, max_z + 1):
+        ul = mercantile.tile(w, n, z)
+        lr = mercantile.tile(e, s, z)
+        yield z, range(ul.x, lr.x + 1), range(ul.y, lr.y + 1)
+
+
+def hilbert_tiles(z, xs, ys):
+    # yield the tiles of a zoom level's range in pmtiles tile id order, by walking
+    # down the quadtree and visiting each node's children in hilbert order
+    def descend(level, x, y):
+        if level == z:
+            yield (x, y, z)
+            return
+
+        shift = z - level - 1
+        children = [(x * 2 + dx, y * 2 + dy) for dx in (0, 1) for dy in (0, 1)]
+        children.sort(
+            key=lambda child: pmtiles_archive.zxy_to_tileid(level + 1, *child)
+        )
+        for cx, cy in children:
+            # skip children with no descendants inside the range
+            if (cx + 1) << shift <= xs.start or cx << shift >= xs.stop:
+                continue
+            if (cy + 1) << shift <= ys.start or cy << shift >= ys.stop:
+                continue
+            yield from descend(level + 1, cx, cy)
+
+    yield from descend(0, 0, 0)
+
+
+def make_tiles(bounds, min_z, max_z):
+    for z, xs, ys in tile_ranges(bounds, min_z, max_z):
+        yield from hilbert_tiles(z, xs, ys)
+
+
+def count_tiles(bounds, min_z, max_z):
+    return sum(len(xs) * len(ys) for _, xs, ys in tile_ranges(bounds, min_z, max_z))
+
+
+def batched(iterable, n):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+
+class MBTilesWriter:
+    def __init__(self, output_file, bounds, min_z, max_z):
+        if os.path.exists(output_file):
+            os.unlink(output_file)
+
+        self.connection = sqlite3.connect(output_file)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute(
+            "CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);"
+        )
+        self.cursor.execute("CREATE TABLE metadata (name text, value text);")
+        self.cursor.executemany(
+            "INSERT INTO metadata (name, value) VALUES (?, ?);",
+            [
+                ("format", "webp"),
+                ("bounds", ",".join(str(c) for c in bounds)),
+                ("minzoom", str(min_z)),
+                ("maxzoom", str(max_z)),
+            ],
+        )
+        self.pending = []
+
+    def write(self, tile, contents):
+        x, y, z = tile
+        # mbtiles uses TMS row numbering
+        tile_row = (1 << z) - y - 1
+        self.pending.append((z, x, tile_row, contents))
+
+    def commit(self):
+        self.cursor.executemany(
+            "INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?);",
+            self.pending,
+        )
+        self.connection.commit()
+        self.pending = []
+
+    def close(self):
+        self.commit()
+        self.cursor.execute(
+            "CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);"
+        )
+        self.connection.commit()
+        self.connection.close()
+
+
+class PMTilesWriter:
+    # with buffered set, tiles only need to arrive in tile id order within each
+    # zoom level. each level is spilled to its own temporary file and they're
+    # copied into the archive in zoom order on close, so it's still clustered
+    def __init__(self, output_file, bounds, min_z, max_z, buffered=False):
+        self.bounds = bounds
+        self.min_z = min_z
+        self.max_z = max_z
+        self.writer = pmtiles_archive.PMTilesWriter(
+            output_file,
+            {"format": "webp", "encoding": "mapbox", "type": "baselayer"},
+            tile_type=pmtiles_archive.TILE_TYPE_WEBP,
+            tile_compression=pmtiles_archive.COMPRESSION_NONE,
+        )
+        self.temp_dir = None
+        if buffered:
+            self.temp_dir = tempfile.mkdtemp(
+                dir=os.path.dirname(os.path.abspath(output_file))
+            )
+        # zoom -> (spill file, [(tile id, length)])
+        self.levels = {}
+
+    def write(self, tile, contents):
+        x, y, z = tile
+        tile_id = pmtiles_archive.zxy_to_tileid(z, x, y)
+        if self.temp_dir is None:
+            self.writer.write_tile(tile_id, contents)
+            return
+
+        if z not in self.levels:
+            spill = open(os.path.join(self.temp_dir, f"{z}.bin"), "w+b")
+            self.levels[z] = (spill, [])
+        spill, tiles = self.levels[z]
+        spill.write(contents)
+        tiles.append((tile_id, len(contents)))
+
+    def commit(self):
+        pass
+
+    def close(self):
+        for z in sorted(self.levels):
+            spill, tiles = self.levels[z]
+            spill.seek(0)
+            for tile_id, length in tiles:
+                self.writer.write_tile(tile_id, spill.read(length))
+            spill.close()
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir)
+
+        self.writer.finalize(self.bounds, self.min_z, self.max_z)
+        print(
+            f"Deduplicated {self.writer.deduplicated_tiles} tiles, "
+            f"saving {self.writer.deduplicated_bytes / 1e6:.2f} MB"
+        )
+
+
+def open_writer(output_file, bounds, min_z, max_z, buffered=False):
+    if output_file.endswith(".pmtiles"):
+        return PMTilesWriter(output_file, bounds, min_z, max_z, buffered)
+    return MBTilesWriter(output_file, bounds, min_z, max_z)
+
+
+class MBTilesReader:
+    def __init__(self, input_file):
+        self.connection = sqlite3.connect(input_file)
+        self.cursor = self.connection.cursor()
+        (self.max_z,) = self.cursor.execute(
+            "SELECT MAX(zoom_level) FROM tiles;"
+        ).fetchone()
+
+    def get_tile(self, x, y, z):
+        row = self.cursor.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;",
+            (z, x, (1 << z) - y - 1),
+        ).fetchone()
+        return row[0] if row else None
+
+    def tiles(self, z):
+        rows = self.connection.execute(
+            "SELECT tile_column, tile_row FROM tiles WHERE zoom_level = ?;", (z,)
+        )
+        for x, tile_row in rows:
+            yield x, (1 << z) - tile_row - 1, z
+
+    def close(self):
+        self.connection.close()
+
+
+class PMTilesReader:
+    def __init__(self, input_file):
+        self.reader = pmtiles_archive.PMTilesReader(input_file)
+        self.max_z = self.reader.max_zoom
+
+    def get_tile(self, x, y, z):
+        return self.reader.get_tile(z, x, y)
+
+    def tiles(self, z):
+        # tile ids are numbered zoom by zoom, so only walk the ids of this zoom
+        first = pmtiles_archive.zxy_to_tileid(z, 0, 0)
+        last = pmtiles_archive.zxy_to_tileid(z + 1, 0, 0)
+        for tile_id in self.reader.tile_ids():
+            if tile_id >= last:
+                break
+            if tile_id >= first:
+                z, x, y = pmtiles_archive.tileid_to_zxy(tile_id)
+                yield x, y, z
+
+    def close(self):
+        self.reader.close()
+
+
+def open_reader(input_file):
+    if input_file.endswith(".pmtiles"):
+        return PMTilesReader(input_file)
+    return MBTilesReader(input_file)
+
+
+class RGBTiler:
+    def __init__(
+        self,
+        input_dataset,
+        output_file,
+        min_z,
+        max_z,
+        interval=0.1,
+        base_val=-10000,
+        max_memory=4096,
+        pyramid=False,
+    ):
+        self.input_dataset = input_dataset
+        self.output_file = output_file
+        self.min_z = min_z
+        self.max_z = max_z
+        self.interval = interval
+        self.base_val = base_val
+        self.max_memory = max_memory
+        self.pyramid = pyramid
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ext_t, ext_v, trace):
+        pass
+
+    def run(self, workers=multiprocessing.cpu_count()):
+        with rasterio.open(self.input_dataset) as dataset:
+            bounds = transform_bounds(dataset.crs, "EPSG:4326", *dataset.bounds)
+            nodata = dataset.nodata if dataset.nodata is not None else 0
+
+        workers, cache_bytes, max_in_flight = plan_memory(self.max_memory, workers)
+        print(
+            f"Using {workers} workers with {cache_bytes // (1024 * 1024)} MB of GDAL cache each, "
+            f"buffering up to {max_in_flight} tiles"
+        )
+
+        ranges = {
+            z: (xs, ys) for z, xs, ys in tile_ranges(bounds, self.min_z, self.max_z)
+        }
+        args = {
+            "base_val": self.base_val,
+            "interval": self.interval,
+            "cache_bytes": cache_bytes,
+            "max_z": self.max_z,
+            "ranges": ranges,
+            "nodata": nodata,
+        }
+        total = count_tiles(bounds, self.min_z, self.max_z)
+
+        # pyramid mode finishes the lower zooms last
+        writer = open_writer(
+            self.output_file, bounds, self.min_z, self.max_z, buffered=self.pyramid
+        )
+        with multiprocessing.Pool(
+            workers, _init_worker, (self.input_dataset, args)
+        ) as pool, tqdm(total=total) as pbar:
+            if self.pyramid:
+                self._run_pyramid(pool, writer, pbar, ranges, nodata, max_in_flight)
+            else:
+                self._run_tiles(pool, writer, pbar, bounds, max_in_flight)
+        writer.close()
+
+    def _run_tiles(self, pool, writer, pbar, bounds, max_in_flight):
+        tiles = make_tiles(bounds, self.min_z, self.max_z)
+        # only hand the pool a bounded number of tiles at a time so encoded
+        # tiles can't pile up faster than they're written. results come back
+        # in tile id order, which keeps pmtiles output clustered
+        for batch in batched(tiles, max_in_flight):
+            for tile, contents in pool.imap(_tile_worker, batch):
+                writer.write(tile, contents)
+                pbar.update(1)
+            writer.commit()
+
+    def _run_pyramid(self, pool, writer, pbar, ranges, nodata, max_in_flight):
+        # only the max zoom is rendered from the sources. workers build whole
+        # subtrees below split_z, and the levels above it are built here from
+        # the subtree roots. roots arrive in hilbert order, so siblings arrive
+        # together and only a few tiles per level are held at once. each level's
+        # tiles are written in tile id order
+        split_z = max(self.min_z, self.max_z - PYRAMID_DEPTH)
+        tiles_per_task = sum(4**d for d in range(self.max_z - split_z + 1))
+        roots = hilbert_tiles(split_z, *ranges[split_z])
+        pending = {}
+
+        def add(tile, elevation, encoding):
+            x, y, z = tile
+            if z == self.min_z:
+                return
+
+            parent = (x // 2, y // 2, z - 1)
+            siblings = pending.setdefault(parent, {})
+            siblings[tile] = elevation
+            children = child_tiles(parent)
+            if len(siblings) < sum(in_range(child, ranges) for child in children):
+                return
+
+            del pending[parent]
+            elevation = downsample([siblings.get(child) for child in children], nodata)
+            encoding.append(pool.apply_async(_encode_worker, ((parent, elevation),)))
+            add(parent, elevation, encoding)
+
+        for batch in batched(roots, max(1, max_in_flight // tiles_per_task)):
+            encoding = []
+            for root, elevation, encoded in pool.imap(_subtree_worker, batch):
+                for tile, contents in encoded:
+                    writer.write(tile, contents)
+                    pbar.update(1)
+                add(root, elevation, encoding)
+
+            for result in encoding:
+                tile, contents = result.get()
+                writer.write(tile, contents)
+                pbar.update(1)
+            writer.commit()
@@ -1,5 +1,6 @@
 import click
 import geojson
+import json
 import multiprocessing
 import os
 import sys
@@ -15,9 +16,84 @@ from tqdm import tqdm
 current_dir = os.path.dirname(__file__)
 sys.path.append(os.path.join(current_dir, "..", "..", "utils"))
 
-from polygons_to_weighted_medial_axes import get_weighted_medial_axis
+from polygons_to_weighted_medial_axes import (
+    MedialAxisCache,
+    get_principal_axis,
+    get_weighted_medial_axis,
+    is_fast_shape,
+)
 from simplify import simplify_geometry
 
+# degree of the B-splines the label lines are smoothed with
+DEGREE = 3
+
+# per-worker globals, set by _init_worker
+global_args = None
+
+
+def _init_worker(args):
+    global global_args
+    global_args = args
+
+
+def smooth_line(line):
+    x, y = line.xy
+    if len(x) < DEGREE + 1:
+        # not enough points to smooth
+        return None
+    # create a B-spline representation of the line
+    tck, u = splprep([x, y], s=2, k=DEGREE)
+    new_x, new_y = splev(np.linspace(0, 1, 100), tck)
+    return LineString([(x, y) for x, y in zip(new_x, new_y)])
+
+
+def label_glacier(task):
+    # simplify a glacier, find its medial axis (unless it was cached), then
+    # simplify and smooth that into a label line. returns the label, the medial
+    # axis if one was made, and how the label was made
+    poly, properties, found, cached_line = task
+    simplified = simplify_geometry(poly, global_args["pre_simplify_tolerance"])
+
+    if is_fast_shape(simplified, global_args["fast_max_area"]):
+        # principal axes are already straight, so they aren't smoothed
+        line, _ = get_principal_axis((simplified, properties))
+        return line, None, "principal"
+
+    if found:
+        medial_axis, method = cached_line, "cached"
+    else:
+        medial_axis, _ = get_weighted_medial_axis((simplified, properties))
+        method = "medial"
+
+    if medial_axis is None:
+        return None, medial_axis, method
+    line = simplify_geometry(medial_axis, global_args["medial_axes_tolerance"])
+    return smooth_line(line), medial_axis, method
+
+
+class FeatureCollectionWriter:
+    # writes a geojson feature collection one feature at a time
+    def __init__(self, output_file, crs):
+        self.file = open(output_file, "w")
+        self.file.write(
+            '{"type": "FeatureCollection", "crs": '
+            + json.dumps(crs)
+            + ', "features": ['
+        )
+        self.count = 0
+
+    def write(self, geometry, properties):
+        if self.count > 0:
+            self.file.write(", ")
+        geojson.dump(
+            geojson.Feature(geometry=geometry, properties=properties), self.file
+        )
+        self.count += 1
+
+    def close(self):
+        self.file.write("]}")
+        self.file.close()
+
 
 @click.command()
 @click.option(
@@ -50,6 +126,26 @@ from simplify import simplify_geometry
     default=multiprocessing.cpu_count(),
     help="Number of workers to use",
 )
+@click.option(
+    "--cache-file",
+    help="Reuse the medial axes of unchanged glaciers from this cache",
+    default="data/temp/glacier-medial-axes.sqlite",
+)
+@click.option(
+    "--max-cache-entries",
+    default=1000000,
+    help="Most medial axes to keep in the cache",
+)
+@click.option(
+    "--fast-max-area",
+    default=0.0,
+    help="Compact glaciers smaller than this, in square units of the input, are labeled by their principal axis instead of their medial axis",
+)
+@click.option(
+    "--chunk-size",
+    default=16,
+    help="Number of glaciers sent to a worker at a time",
+)
 def cli(
     input_file,
     cleaned_glaciers_output_file,
@@ -57,6 +153,10 @@ def cli(
     pre_simplify_tolerance,
     medial_axes_tolerance,
     workers,
+    cache_file,
+    max_cache_entries,
+    fast_max_area,
+    chunk_size,
 ):
     print("Combining glaciers with the same name...")
     # load the input geojson
@@ -153,68 +253,50 @@ def cli(
 
         combined_glacier_polygons.append((poly, properties))
 
-    print("Creating simplified glacier boundaries...")
-
-    simplified_glaciers = []
-    for poly, properties in tqdm(combined_glacier_polygons):
-        simplified_polygon = simplify_geometry(poly, pre_simplify_tolerance)
-        simplified_glaciers.append((simplified_polygon, properties))
+    print("Creating glacier labels...")
 
-    print("Creating medial axes from simplified boundaries...")
+    # the cache is only used from this process, so look up every glacier
+    # before handing them to the workers
+    cache = MedialAxisCache(cache_file, max_cache_entries)
+    tasks = []
+    for poly, properties in combined_glacier_polygons:
+        key = MedialAxisCache.key(poly, pre_simplify_tolerance)
+        found, line = cache.get(key)
+        tasks.append((key, (poly, properties, found, line)))
 
-    medial_axes = []
-    with multiprocessing.Pool(workers) as p:
-        for line, properties in tqdm(
-            p.imap_unordered(get_weighted_medial_axis, simplified_glaciers),
-            total=len(simplified_glaciers),
+    args = {
+        "pre_simplify_tolerance": pre_simplify_tolerance,
+        "medial_axes_tolerance": medial_axes_tolerance,
+        "fast_max_area": fast_max_area,
+    }
+    labels = FeatureCollectionWriter(labels_output_file, gj["crs"])
+    cleaned = FeatureCollectionWriter(cleaned_glaciers_output_file, gj["crs"])
+    methods = {"principal": 0, "medial": 0, "cached": 0}
+    with multiprocessing.Pool(
+        workers, initializer=_init_worker, initargs=(args,)
+    ) as pool:
+        results = pool.imap(
+            label_glacier, (task for _, task in tasks), chunksize=chunk_size
+        )
+        for (key, task), (label, medial_axis, method) in tqdm(
+            zip(tasks, results), total=len(tasks)
         ):
-            if line is None:
-                continue
-            medial_axes.append((line, properties))
-
-    print("Simplifying medial axes...")
+            poly, properties, _, _ = task
+            if method == "medial":
+                cache.put(key, medial_axis)
+            methods[method] += 1
 
-    simplified_medial_axes = []
-    for line, properties in tqdm(medial_axes):
-        simplified_line = simplify_geometry(line, medial_axes_tolerance)
-        simplified_medial_axes.append((simplified_line, properties))
+            if label is not None:
+                labels.write(label, properties)
+            cleaned.write(poly, properties)
 
-    print("Creating B-Splines from simplified medial axes...")
-
-    DEGREE = 3
-    smoothed_medial_axes = []
-    for line, properties in tqdm(simplified_medial_axes):
-        x, y = line.xy
-        if len(x) < DEGREE + 1:
-            # not enough points to smooth
-            continue
-        # create a B-spline representation of the line
-        tck, u = splprep([x, y], s=2, k=DEGREE)
-        new_x, new_y = splev(np.linspace(0, 1, 100), tck)
-        smoothed_line = LineString([(x, y) for x, y in zip(new_x, new_y)])
-        smoothed_medial_axes.append((smoothed_line, properties))
-
-    # save the simplified medial axes
-    with open(labels_output_file, "w") as f:
-        gj = geojson.FeatureCollection(
-            [
-                geojson.Feature(geometry=line, properties=properties)
-                for line, properties in smoothed_medial_axes
-            ],
-            crs=gj["crs"],
-        )
-        geojson.dump(gj, f)
-
-    # save the combined glacier polygons
-    with open(cleaned_glaciers_output_file, "w") as f:
-        gj = geojson.FeatureCollection(
-            [
-                geojson.Feature(geometry=poly, properties=properties)
-                for poly, properties in combined_glacier_polygons
-            ],
-            crs=gj["crs"],
-        )
-        geojson.dump(gj, f)
+    cache.close()
+    labels.close()
+    cleaned.close()
+    print(
+        f"Labeled {methods['principal']} glaciers by their principal axis, "
+        f"{methods['medial']} by their medial axis and {methods['cached']} from the cache"
+    )
 
 
 if __name__ == "__main__":
@@ -1,11 +1,70 @@
 import click
-import uuid
+import multiprocessing
+
+import numpy as np
+import shapely
 
 from shapely.geometry import Polygon
-from rtree import index
+from tqdm import tqdm
 
 import fiona
 
+# polygons closer than this are considered touching
+TOUCHING_DISTANCE = 0.00001
+
+
+def find_root(parents, i):
+    # find the root of i's set, flattening the path to it
+    root = i
+    while parents[root] != root:
+        root = parents[root]
+    while parents[i] != root:
+        parents[i], i = root, parents[i]
+    return root
+
+
+def find_components(polygons, names):
+    # group touching glaciers with the same name, or where one of them has no
+    # name. a group takes the name of its first named glacier, and two groups
+    # with different names are never joined, even through an unnamed glacier
+    tree = shapely.STRtree(polygons)
+    left, right = tree.query(polygons, predicate="dwithin", distance=TOUCHING_DISTANCE)
+    pairs = left < right
+    left, right = left[pairs], right[pairs]
+
+    unnamed = np.array([name is None for name in names])
+    same_name = np.array(
+        [names[i] == names[j] for i, j in zip(left, right)], dtype=bool
+    )
+    compatible = same_name | unnamed[left] | unnamed[right]
+    left, right = left[compatible], right[compatible]
+
+    # glaciers were merged from the end of the file first, so join the pairs
+    # in that order too
+    order = np.lexsort((-right, -left))
+    parents = list(range(len(polygons)))
+    group_names = list(names)
+    for i, j in zip(left[order], right[order]):
+        root_i, root_j = find_root(parents, i), find_root(parents, j)
+        if root_i == root_j:
+            continue
+        name_i, name_j = group_names[root_i], group_names[root_j]
+        if name_i is not None and name_j is not None and name_i != name_j:
+            continue
+        parents[root_j] = root_i
+        group_names[root_i] = name_i if name_i is not None else name_j
+
+    components = {}
+    for i in range(len(polygons)):
+        components.setdefault(find_root(parents, i), []).append(i)
+    return list(components.values())
+
+
+def combine_component(polygons):
+    if len(polygons) == 1:
+        return polygons[0]
+    return shapely.unary_union(polygons)
+
 
 @click.command()
 @click.option(
@@ -18,119 +77,80 @@ import fiona
     help="The output geopackage",
     default="data/temp/glaciers.gpkg",
 )
+@click.option(
+    "--workers", default=multiprocessing.cpu_count(), help="Number of workers to use"
+)
 def cli(
     input_file,
     output_file,
+    workers,
 ):
     # load the input file
     with fiona.open(input_file) as src:
-        polygons = {}
-        # load the polygons into an rtree
-        idx = index.Index()
+        crs = src.crs
+        schema = src.schema
+        polygons = []
+        properties = []
         for feature in src:
             # get feature geometry
-            geom = feature["geometry"]
-            poly = Polygon(geom["coordinates"][0])
-            new_id = uuid.uuid4().int
-            polygons[new_id] = {
-                "polygon": poly,
-                "id": new_id,
-                "properties": feature["properties"],
-            }
-            idx.insert(
-                new_id,
-                poly.envelope.bounds,
-                obj=polygons[new_id],
+            polygons.append(Polygon(feature["geometry"]["coordinates"][0]))
+            properties.append(dict(feature["properties"]))
+
+    print("Combining touching glaciers with the same name or no name...")
+    names = [p["glac_name"] for p in properties]
+    components = find_components(polygons, names)
+
+    with multiprocessing.Pool(workers) as pool:
+        combined = list(
+            tqdm(
+                pool.imap(
+                    combine_component,
+                    ([polygons[i] for i in component] for component in components),
+                    chunksize=64,
+                ),
+                total=len(components),
             )
-
-        unchecked_ids = [poly_id for poly_id in polygons]
-
-        print("Combining touching glaciers with the same name or no name...")
-        while len(unchecked_ids) > 0:
-            poly_id = unchecked_ids.pop()
-
-            if poly_id not in polygons:
-                # this polygon was already combined with another
-                continue
-
-            p = polygons[poly_id]
-            poly = p["polygon"]
-            buffered_poly = poly.buffer(0.00001)
-            # get the neighbors of the polygon from the rtree
-            neighbors = list(idx.intersection(poly.envelope.bounds, objects=True))
-            neighbors = [n.object for n in neighbors if n.object["id"] != poly_id]
-
-            # combine the polygon with any neighbor that has the same name OR has no name and is touching
-            for neighbor in neighbors:
-                neighbor_poly = neighbor["polygon"]
-                if (
-                    neighbor["properties"]["glac_name"] == p["properties"]["glac_name"]
-                    and neighbor_poly.intersects(buffered_poly)
-                ) or (
-                    neighbor["properties"]["glac_name"] == None
-                    and neighbor_poly.intersects(buffered_poly)
-                ):
-                    combined_poly = poly.union(neighbor_poly)
-                    # remove the neighbor and current polygon from the rtree
-                    idx.delete(neighbor["id"], neighbor_poly.envelope.bounds)
-                    idx.delete(poly_id, poly.envelope.bounds)
-
-                    del polygons[poly_id]
-                    del polygons[neighbor["id"]]
-
-                    # add a new polygon to the tree with the combined polygon
-                    new_poly_id = uuid.uuid4().int
-                    unchecked_ids.append(new_poly_id)
-                    polygons[new_poly_id] = {
-                        "polygon": combined_poly,
-                        "id": new_poly_id,
-                        "properties": p["properties"],
-                    }
-                    idx.insert(
-                        new_poly_id,
-                        combined_poly.envelope.bounds,
-                        obj={
-                            "polygon": combined_poly,
-                            "id": new_poly_id,
-                            "properties": p["properties"],
-                        },
-                    )
-                    break
-
-        combined_glacier_polygons = []
-        for poly_id in polygons:
-            poly = polygons[poly_id]["polygon"]
-            properties = polygons[poly_id]["properties"]
-
-            # check if the polygon is simple
+        )
+
+    combined_glacier_polygons = []
+    for component, poly in zip(components, combined):
+        # a combined glacier keeps the properties of its last named glacier, or
+        # its last glacier if none are named
+        named = [i for i in component if names[i] is not None]
+        component_properties = properties[max(named) if named else max(component)]
+
+        # check if the polygon is simple
+        if not poly.is_simple or not poly.is_valid:
+            print("Polygon is not simple or valid, attempting to fix...")
+            # if not, make it simple
+            poly = poly.buffer(0)
             if not poly.is_simple or not poly.is_valid:
-                print("Polygon is not simple or valid, attempting to fix...")
-                # if not, make it simple
-                poly = poly.buffer(0)
-                if not poly.is_simple or not poly.is_valid:
-                    raise Exception("Failed to make polygon simple and valid")
-
-            combined_glacier_polygons.append((poly, properties))
-
-        # write the combined polygons to a new geopackage
-        print(f"Saving {len(combined_glacier_polygons)} glaciers...")
-        with fiona.open(
-            output_file,
-            "w",
-            driver="GPKG",
-            crs=src.crs,
-            schema=src.schema,
-        ) as dst:
-            for poly, properties in combined_glacier_polygons:
-                dst.write(
-                    {
-                        "geometry": {
-                            "type": "Polygon",
-                            "coordinates": [list(poly.exterior.coords)],
-                        },
-                        "properties": properties,
-                    }
-                )
+                raise Exception("Failed to make polygon simple and valid")
+
+        # glaciers that are close but don't overlap combine into several parts,
+        # which are saved separately
+        for part in shapely.get_parts(poly):
+            combined_glacier_polygons.append((part, component_properties))
+
+    # write the combined polygons to a new geopackage
+    print(f"Saving {len(combined_glacier_polygons)} glaciers...")
+    with fiona.open(
+        output_file,
+        "w",
+        driver="GPKG",
+        crs=crs,
+        schema=schema,
+    ) as dst:
+        dst.writerecords(
+            {
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [list(poly.exterior.coords)],
+                },
+                "properties": properties,
+            }
+            for poly, properties in combined_glacier_polygons
+        )
 
 
 if __name__ == "__main__":
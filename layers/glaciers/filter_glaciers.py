@@ -26,8 +26,8 @@ import fiona
 )
 @click.option(
     "--input-file",
-    default="data/sources/glims_polygons.shp",
-    help="The input shapefile to trim and filter.",
+    default="data/sources/glims_polygons.gpkg",
+    help="The input glaciers, ideally ingested into a spatially indexed geopackage.",
 )
 @click.option(
     "--output-file",
@@ -40,7 +40,8 @@ def cli(bbox, filter_names, filter_year, input_file, output_file):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    xmin, ymin, xmax, ymax = [float(x) for x in bbox.split(",")]
+    x1, y1, x2, y2 = [float(x) for x in bbox.split(",")]
+    xmin, ymin, xmax, ymax = min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
     name_blacklist = filter_names.split(",")
 
     with fiona.open(input_file) as src:
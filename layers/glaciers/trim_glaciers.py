@@ -1,10 +1,67 @@
 import click
+import itertools
 import os
 
+import fiona
+import numpy as np
+import shapely
+
+from shapely.geometry import box, mapping, shape
 from tqdm import tqdm
-from osgeo import ogr, gdal
 
-gdal.UseExceptions()
+
+def clip(geometries, bbox):
+    try:
+        return shapely.intersection(geometries, bbox)
+    except shapely.errors.GEOSException:
+        # some of the chunk's geometries are too broken to clip, so clip them
+        # one at a time and drop those
+        clipped = np.empty(len(geometries), dtype=object)
+        for i, geometry in enumerate(geometries):
+            try:
+                clipped[i] = geometry.intersection(bbox)
+            except shapely.errors.GEOSException:
+                clipped[i] = None
+        return clipped
+
+
+def trim_chunk(features, bbox, name_blacklist, filter_year):
+    # clip a chunk of glaciers to the bbox and filter them, as arrays
+    anlys_times = np.array(
+        [feature["properties"]["anlys_time"] for feature in features], dtype=object
+    )
+    # verify the anlys_time is greater than or equal to the filter year
+    # format will be like 2023-02-16T00:00:00
+    years = np.array(
+        [-1 if t is None else int(t.split("-")[0]) for t in anlys_times], dtype=int
+    )
+    keep = years >= int(filter_year)
+
+    geometries = np.array(
+        [shape(feature["geometry"]) for feature in features], dtype=object
+    )
+    keep[keep] = shapely.intersects(geometries[keep], bbox)
+    indices = np.nonzero(keep)[0]
+
+    clipped = clip(geometries[indices], bbox)
+    polygons = shapely.get_type_id(clipped) == shapely.GeometryType.POLYGON
+    indices, clipped = indices[polygons], clipped[polygons]
+
+    invalid = ~shapely.is_valid(clipped)
+    clipped[invalid] = shapely.make_valid(clipped[invalid])
+
+    for i, geometry in zip(indices, clipped):
+        properties = features[i]["properties"]
+        glac_name = properties["glac_name"]
+        yield {
+            "geometry": mapping(geometry),
+            "properties": {
+                # ignore any glacier names in the name blacklist
+                "glac_name": None if glac_name in name_blacklist else glac_name,
+                "area": properties["area"],
+                "anlys_time": anlys_times[i],
+            },
+        }
 
 
 @click.command()
@@ -25,98 +82,62 @@ gdal.UseExceptions()
 )
 @click.option(
     "--input-file",
-    default="data/sources/glims_polygons.shp",
-    help="The input shapefile to trim and filter.",
+    default="data/sources/glims_polygons.gpkg",
+    help="The input glaciers, ideally ingested into a spatially indexed geopackage.",
 )
 @click.option(
     "--output-file",
     default="data/temp/glaciers.geojson",
-    help="The output geojson file.",
+    help="The output geojson file, or a geopackage if it ends in .gpkg.",
 )
-def cli(bbox, filter_names, filter_year, input_file, output_file):
+@click.option(
+    "--chunk-size",
+    default=10000,
+    help="Number of glaciers clipped at a time.",
+)
+def cli(bbox, filter_names, filter_year, input_file, output_file, chunk_size):
     # make sure the path to the output exists, and if not make it
     output_dir = os.path.dirname(output_file)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    xmin, ymin, xmax, ymax = [float(x) for x in bbox.split(",")]
+    x1, y1, x2, y2 = [float(x) for x in bbox.split(",")]
+    xmin, ymin, xmax, ymax = min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
     name_blacklist = filter_names.split(",")
-
-    ds = ogr.Open(input_file)
-    if ds is None:
-        raise Exception(f"Failed to open {input_file}")
-    layer = ds.GetLayer()
-
-    # Create a temp shapefile for the clipped features
-    driver = ogr.GetDriverByName("GeoJSON")
-    temp_ds = driver.CreateDataSource(output_file)
-    temp_layer = temp_ds.CreateLayer(
-        "glaciers", geom_type=ogr.wkbPolygon, srs=layer.GetSpatialRef()
-    )
-
-    glac_name_field = ogr.FieldDefn("glac_name", ogr.OFTString)
-    glac_name_field.SetWidth(254)
-    temp_layer.CreateField(glac_name_field)
-
-    glac_area_field = ogr.FieldDefn("area", ogr.OFTReal)
-    glac_area_field.SetWidth(254)
-    temp_layer.CreateField(glac_area_field)
-
-    anlys_time_field = ogr.FieldDefn("anlys_time", ogr.OFTString)
-    anlys_time_field.SetWidth(254)
-    temp_layer.CreateField(anlys_time_field)
-
-    # create a geometry to represent the bounding box
-    ring = ogr.Geometry(ogr.wkbLinearRing)
-    ring.AddPoint(xmin, ymin)
-    ring.AddPoint(xmin, ymax)
-    ring.AddPoint(xmax, ymax)
-    ring.AddPoint(xmax, ymin)
-    ring.AddPoint(xmin, ymin)
-    bbox = ogr.Geometry(ogr.wkbPolygon)
-    bbox.AddGeometry(ring)
-
-    print("Clipping features...")
-    for feature in tqdm(layer):
-        geom = feature.GetGeometryRef()
-        if geom.Intersects(bbox):
-            clipped_geometry = geom.Intersection(bbox)
-
-            if clipped_geometry is None:
-                continue
-            if clipped_geometry.GetGeometryName() != "POLYGON":
-                continue
-
-            if not clipped_geometry.IsValid():
-                clipped_geometry = clipped_geometry.MakeValid()
-                if clipped_geometry is None:
-                    continue
-
-            # verify the anlys_time is greater than or equal to the filter year
-            # format will be like 2023-02-16T00:00:00
-            anlys_time = feature.GetField("anlys_time")
-            if anlys_time is None:
-                continue
-
-            anlys_year = int(anlys_time.split("-")[0])
-            if anlys_year < int(filter_year):
-                continue
-
-            clipped_feature = ogr.Feature(temp_layer.GetLayerDefn())
-
-            # ignore any glacier names in the name blacklist
-            glac_name = feature.GetField("glac_name")
-            if glac_name not in name_blacklist:
-                clipped_feature.SetField("glac_name", glac_name)
-
-            clipped_feature.SetField("anlys_time", anlys_time)
-            clipped_feature.SetField("area", feature.GetField("area"))
-
-            clipped_feature.SetGeometry(clipped_geometry)
-            temp_layer.CreateFeature(clipped_feature)
-
-    ds = None
-    temp_ds = None
+    bbox = box(xmin, ymin, xmax, ymax)
+
+    if output_file.endswith(".gpkg"):
+        # geopackages get an r-tree spatial index
+        driver_options = {"driver": "GPKG", "SPATIAL_INDEX": "YES"}
+    else:
+        driver_options = {"driver": "GeoJSON"}
+
+    with fiona.open(input_file) as src:
+        # only read features near the bbox, which is an index lookup in a
+        # geopackage
+        features = iter(src.filter(bbox=(xmin, ymin, xmax, ymax)))
+
+        with fiona.open(
+            output_file,
+            "w",
+            crs=src.crs,
+            schema={
+                "geometry": "Unknown",
+                "properties": {
+                    "glac_name": "str",
+                    "area": "float",
+                    "anlys_time": "str",
+                },
+            },
+            layer="glaciers",
+            **driver_options,
+        ) as dst:
+            print("Clipping features...")
+            progress = tqdm()
+            while chunk := list(itertools.islice(features, chunk_size)):
+                dst.writerecords(trim_chunk(chunk, bbox, name_blacklist, filter_year))
+                progress.update(len(chunk))
+            progress.close()
 
 
 if __name__ == "__main__":
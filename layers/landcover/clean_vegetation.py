@@ -1,6 +1,35 @@
 import click
+import os
+import threading
+
+import numpy as np
 import rasterio
 
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.enums import Resampling
+from tqdm import tqdm
+
+# size of the output's tiles, unless the input is tiled too
+BLOCK_SIZE = 512
+OVERVIEW_FACTORS = [2, 4, 8, 16, 32]
+
+
+def output_profile(src):
+    # a tiled, compressed copy of the input's profile. tiled inputs keep their
+    # tile size, so each of their tiles is read and written once
+    profile = src.profile.copy()
+    block_height, block_width = src.block_shapes[0]
+    tiled = src.profile.get("tiled", False) and block_width % 16 == 0
+    profile.update(
+        tiled=True,
+        blockxsize=block_width if tiled else BLOCK_SIZE,
+        blockysize=block_height if tiled else BLOCK_SIZE,
+        compress="deflate",
+        predictor=2 if np.dtype(src.dtypes[0]).kind in "iu" else 3,
+        BIGTIFF="IF_SAFER",
+    )
+    return profile
+
 
 @click.command()
 @click.option(
@@ -21,7 +50,12 @@ import rasterio
     required=True,
     help="Comma separated list of pixel values to filter out",
 )
-def cli(input_file, output_file, filter_values):
+@click.option(
+    "--workers",
+    default=os.cpu_count(),
+    help="Number of threads filtering blocks",
+)
+def cli(input_file, output_file, filter_values, workers):
     # split the filter values
     filter_values = filter_values.split(",")
     filter_values = [int(x) for x in filter_values]
@@ -29,16 +63,32 @@ def cli(input_file, output_file, filter_values):
     # load the input file with rasterio
     with rasterio.open(input_file) as src:
         print(f"Setting pixel values {filter_values} to {src.nodata}...")
-        # filter out the values
-        data = src.read(1)
-        for value in filter_values:
-            data[data == value] = src.nodata
-
-        # write the output file
-        print("Writing output file...")
-        profile = src.profile
+        profile = output_profile(src)
+        # integer rasters are filtered with a lookup table of the values
+        kind = "table" if np.dtype(src.dtypes[0]).kind in "iu" else None
+
         with rasterio.open(output_file, "w", **profile) as dst:
-            dst.write(data, 1)
+            read_lock = threading.Lock()
+            write_lock = threading.Lock()
+
+            def filter_block(window):
+                with read_lock:
+                    data = src.read(1, window=window)
+                # filter out the values
+                data[np.isin(data, filter_values, kind=kind)] = src.nodata
+                with write_lock:
+                    dst.write(data, 1, window=window)
+
+            windows = [window for _, window in dst.block_windows(1)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for _ in tqdm(executor.map(filter_block, windows), total=len(windows)):
+                    pass
+
+    print("Building overviews...")
+    with rasterio.open(output_file, "r+") as dst:
+        factors = [f for f in OVERVIEW_FACTORS if min(dst.width, dst.height) // f > 0]
+        dst.build_overviews(factors, Resampling.nearest)
+        dst.update_tags(ns="rio_overview", resampling="nearest")
 
 
 if __name__ == "__main__":
@@ -4,15 +4,80 @@ import os
 import pandas as pd
 import fiona
 import json
+import numpy as np
+import rasterio
+import sqlite3
 
 from tqdm import tqdm
 
 
+def has_index(cursor, table, column):
+    # whether the table has an index that starts with the column
+    cursor.execute(f'PRAGMA index_list("{table}");')
+    for index in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'PRAGMA index_info("{index}");')
+        columns = cursor.fetchall()
+        if columns and columns[0][2] == column:
+            return True
+    return False
+
+
+def gpkg_labels(input_file, label_field):
+    # let sqlite find the distinct labels of the first features table
+    connection = sqlite3.connect(input_file)
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT table_name FROM gpkg_contents WHERE data_type = 'features';"
+    )
+    table = cursor.fetchone()[0]
+    if has_index(cursor, table, label_field):
+        # step from each label to the next one in the index, which only takes a
+        # lookup per label however many polygons there are
+        labels = []
+        query = f'SELECT MIN("{label_field}") FROM "{table}"'
+        label = cursor.execute(f'{query};').fetchone()[0]
+        while label is not None:
+            labels.append(label)
+            label = cursor.execute(
+                f'{query} WHERE "{label_field}" > ?;', (label,)
+            ).fetchone()[0]
+    else:
+        # without an index this reads every polygon
+        cursor.execute(f'SELECT DISTINCT "{label_field}" FROM "{table}";')
+        labels = [row[0] for row in cursor.fetchall() if row[0] is not None]
+    connection.close()
+    return labels
+
+
+def raster_labels(input_file):
+    # the distinct values of the raster, a block at a time. they're returned as
+    # floats, like the labels of the polygonized raster
+    labels = set()
+    with rasterio.open(input_file) as src:
+        for _, window in tqdm(list(src.block_windows(1))):
+            data = src.read(1, window=window, masked=True)
+            labels.update(np.unique(data.compressed()).tolist())
+    return [float(label) for label in labels]
+
+
+def geojson_labels(input_file, label_field):
+    labels = set()
+    with fiona.open(input_file, 'r') as f:
+        for feature in tqdm(f):
+            labels.add(feature.properties[label_field])
+    return list(labels)
+
+
 @click.command()
 @click.option(
     '--input-file',
-    default="data/temp/landcover.geojsons",
-    help='Vectorized landcover geojson file'
+    default="data/temp/stitched.gpkg",
+    help='Vectorized landcover geopackage or geojson file, or the landcover raster'
+)
+@click.option(
+    '--label-field',
+    default='label',
+    help='The property of the polygons with their landcover value',
 )
 @click.option(
     '--values-file',
@@ -24,7 +89,7 @@ from tqdm import tqdm
     default="data/output/classes.json",
     help='Output JSON file',
 )
-def cli(input_file, values_file, output_file):
+def cli(input_file, label_field, values_file, output_file):
     inputs = glob.glob(input_file)
     if len(inputs) >= 1:
         input_file = inputs[0]
@@ -46,22 +111,29 @@ def cli(input_file, values_file, output_file):
     # read the values file
     df = pd.read_csv(values_file)
 
-    label_lookup = {}
+    # index the values by their VALUE
+    values = df.drop_duplicates('VALUE').set_index('VALUE')
 
-    print("Loading geojson file...")
-    with fiona.open(input_file, 'r') as f:
+    print("Finding labels...")
+    if input_file.endswith('.gpkg'):
+        labels = gpkg_labels(input_file, label_field)
+    elif input_file.endswith(('.tif', '.tiff')):
+        labels = raster_labels(input_file)
+    else:
+        labels = geojson_labels(input_file, label_field)
 
-        print("Creating label lookup...")
-        for feature in tqdm(f):
-            # get the feature's label from properties
-            label = feature.properties['label']
-            value = df[df['VALUE'] == int(label)].iloc[0]
-            label_lookup[label] = {
-                'name': value['EVT_NAME'],
-                'class': value['EVT_CLASS'],
-                'subclass': value['EVT_SBCLS'],
-                'color': "#bbd1b8"  # setting a default color
-            }
+    print(f"Creating label lookup for {len(labels)} labels...")
+    label_lookup = {}
+    for label in sorted(labels, key=float):
+        if int(label) not in values.index:
+            raise ValueError(f'Label {label} is not in {values_file}')
+        value = values.loc[int(label)]
+        label_lookup[label] = {
+            'name': value['EVT_NAME'],
+            'class': value['EVT_CLASS'],
+            'subclass': value['EVT_SBCLS'],
+            'color': "#bbd1b8"  # setting a default color
+        }
 
     print("Writing output file...")
     with open(output_file, 'w') as f:
@@ -0,0 +1,149 @@
+import click
+import multiprocessing
+import multiprocessing.util
+import os
+
+import rasterio
+
+from affine import Affine
+from tqdm import tqdm
+
+from processing import SharedRaster, TileWriter, VectorizerParameters, process_tile
+
+
+# what process_tile needs to know about the raster it's cutting tiles from
+class TilerParameters:
+    def __init__(self, data, transform, crs, endx, endy, debug=False):
+        self.data = data
+        self.transform = transform
+        self.crs = crs
+        # x is the row axis of the raster and y the column axis
+        self.endx = endx
+        self.endy = endy
+        self.debug = debug
+        self.render_raster_config = None
+
+
+# per-worker globals, set by _init_worker
+tiler_parameters = None
+parameters = None
+
+
+def _init_worker(tiler_args, vectorizer_args):
+    global tiler_parameters, parameters
+    tiler_parameters = tiler_args
+    parameters = vectorizer_args
+    # unmap the shared raster when the worker exits
+    multiprocessing.util.Finalize(None, tiler_parameters.data.close, exitpriority=10)
+
+
+def _tile_worker(tile_constraints):
+    return process_tile(tile_constraints, tiler_parameters, parameters)
+
+
+@click.command()
+@click.option(
+    "--input-file",
+    type=click.Path(file_okay=True, dir_okay=False),
+    help="The landcover class raster",
+    default="data/temp/filtered.tif",
+)
+@click.option(
+    "--output-file",
+    help="The output geopackage",
+    default="data/temp/combined.gpkg",
+)
+@click.option(
+    "--tile-size",
+    help="Width and height in pixels of the tiles the raster is polygonized in",
+    default=1000,
+)
+@click.option(
+    "--min-blob-size",
+    type=click.IntRange(min=2),
+    help="Areas of fewer pixels than this are merged into their neighbours",
+    default=5,
+)
+@click.option(
+    "--simplification-pixel-window",
+    help="Tolerance of the polygon simplification, in pixels",
+    default=1,
+)
+@click.option(
+    "--batch-size",
+    help="Number of polygons written to the output at a time",
+    default=100000,
+)
+@click.option(
+    "--workers", default=multiprocessing.cpu_count(), help="Number of workers to use"
+)
+def cli(
+    input_file,
+    output_file,
+    tile_size,
+    min_blob_size,
+    simplification_pixel_window,
+    batch_size,
+    workers,
+):
+    # make the path to the output directory if it doesn't exist
+    output_dir = os.path.dirname(output_file)
+    if output_dir != "" and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # process_tile always trims a buffer of pixels off each side of the tiles,
+    # so the raster is padded with nodata by that much and the tiles start
+    # inside the padding
+    buffer = min_blob_size - 1
+    # the workers all map the same copy of the raster
+    data = SharedRaster.from_file(input_file, padding=buffer)
+    with rasterio.open(input_file) as src:
+        tiler_args = TilerParameters(
+            data,
+            src.transform * Affine.translation(-buffer, -buffer),
+            src.crs,
+            src.height + 2 * buffer,
+            src.width + 2 * buffer,
+        )
+        vectorizer_args = VectorizerParameters(
+            min_blob_size=min_blob_size,
+            meters_per_pixel=src.res[0],
+            simplification_pixel_window=simplification_pixel_window,
+        )
+        tiles = [
+            (
+                x,
+                y,
+                min(tile_size, src.height + buffer - x),
+                min(tile_size, src.width + buffer - y),
+            )
+            for x in range(buffer, src.height + buffer, tile_size)
+            for y in range(buffer, src.width + buffer, tile_size)
+        ]
+
+    print(f"Polygonizing {len(tiles)} tiles...")
+    writer = TileWriter(output_file, tiler_args.crs, batch_size=batch_size)
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_worker, initargs=(tiler_args, vectorizer_args)
+    )
+    try:
+        # each tile's polygons come back as WKB and go straight to the
+        # geopackage, a batch at a time
+        for result in tqdm(pool.imap_unordered(_tile_worker, tiles), total=len(tiles)):
+            writer.write(result)
+        # let the workers exit on their own, so they close the shared raster
+        # before it's unlinked
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        data.close()
+
+    print("Indexing polygons...")
+    writer.close()
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,18 +1,16 @@
 import os
-import sys
 
-from shapely.geometry import LineString
-from shapely.affinity import translate
+from multiprocessing import shared_memory
+import numpy as np
+import rasterio
+import shapely
 import geopandas as gpd
+from osgeo import ogr
 
 import utils.visualization as viz
 from utils.blobifier import blobify
 from utils.vectorizer.vector_builder import VectorBuilder
 
-curr_dir = os.path.dirname(__file__)
-sys.path.append(os.path.join(curr_dir, "..", "..", "utils"))
-from simplify import simplify_geometry
-
 
 class VectorizerParameters:
     def __init__(
@@ -26,6 +24,147 @@ class VectorizerParameters:
         self.simplification_pixel_window = simplification_pixel_window
 
 
+# a class raster in shared memory. the tiler creates it once and hands it to
+# the workers as tiler_parameters.data. only its name, shape and dtype are
+# pickled, and each worker maps the same memory instead of getting a copy
+class SharedRaster:
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._shm = None
+        self._array = None
+        # the process that created the memory, which is the one to unlink it.
+        # forked workers inherit the creator's object, so it's a pid
+        self._owner_pid = None
+
+    @classmethod
+    def create(cls, shape, dtype):
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        raster = cls(shm.name, shape, dtype)
+        raster._shm = shm
+        raster._owner_pid = os.getpid()
+        return raster
+
+    @classmethod
+    def from_array(cls, data):
+        raster = cls.create(data.shape, data.dtype)
+        raster.array()[:] = data
+        return raster
+
+    @classmethod
+    def from_file(cls, input_file, band=1, padding=0):
+        # read the band straight into shared memory, so it's never in memory
+        # twice, optionally padded with nodata on every side
+        with rasterio.open(input_file) as src:
+            raster = cls.create(
+                (src.height + 2 * padding, src.width + 2 * padding),
+                src.dtypes[band - 1],
+            )
+            array = raster.array()
+            if padding == 0:
+                src.read(band, out=array)
+                return raster
+
+            array[:] = src.nodata if src.nodata is not None else 0
+            for _, window in src.block_windows(band):
+                row = window.row_off + padding
+                col = window.col_off + padding
+                array[row : row + window.height, col : col + window.width] = src.read(
+                    band, window=window
+                )
+        return raster
+
+    def array(self):
+        if self._array is None:
+            if self._shm is None:
+                self._shm = shared_memory.SharedMemory(name=self.name)
+            self._array = np.ndarray(self.shape, self.dtype, buffer=self._shm.buf)
+        return self._array
+
+    def window(self, x0, x1, y0, y1):
+        # a copy of a window, so changes to it don't reach the other workers
+        return np.array(self.array()[x0:x1, y0:y1])
+
+    def __getstate__(self):
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype.str}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def close(self):
+        # workers close their mapping, only the raster's creator unlinks it.
+        # workers share their parent's resource tracker, so the segment they
+        # register when attaching is the one the unlink unregisters
+        self._array = None
+        if self._shm is not None:
+            self._shm.close()
+            if self._owner_pid == os.getpid():
+                self._shm.unlink()
+            self._shm = None
+
+
+# appends the polygons of each tile to one geopackage, in transactions of at
+# least batch_size polygons, and builds its spatial index once at the end
+class TileWriter:
+    def __init__(self, output_file, crs, layer="landcover", batch_size=100000):
+        if os.path.exists(output_file):
+            os.unlink(output_file)
+        self.output_file = output_file
+        self.crs = crs
+        self.layer = layer
+        self.batch_size = batch_size
+        self.pending_geometries = []
+        self.pending_labels = []
+        self.pending_count = 0
+        self.created = False
+
+    def write(self, result):
+        geometries, labels = result
+        if len(labels) == 0:
+            return
+        self.pending_geometries.append(geometries)
+        self.pending_labels.append(labels)
+        self.pending_count += len(labels)
+        if self.pending_count >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending_count == 0:
+            return
+        gdf = gpd.GeoDataFrame(
+            {"label": np.concatenate(self.pending_labels)},
+            geometry=shapely.from_wkb(np.concatenate(self.pending_geometries)),
+            crs=self.crs,
+        )
+        gdf.to_file(
+            self.output_file,
+            layer=self.layer,
+            driver="GPKG",
+            mode="a" if self.created else "w",
+            SPATIAL_INDEX="NO",
+        )
+        self.created = True
+        self.pending_geometries = []
+        self.pending_labels = []
+        self.pending_count = 0
+
+    def close(self):
+        self.flush()
+        if not self.created:
+            return
+        ds = ogr.Open(self.output_file, 1)
+        geometry_column = ds.GetLayerByName(self.layer).GetGeometryColumn()
+        ds.ExecuteSQL(
+            f"SELECT CreateSpatialIndex('{self.layer}', '{geometry_column}')"
+        )
+        # an index on the labels lets their distinct values be found without
+        # reading every polygon
+        ds.ExecuteSQL(f'CREATE INDEX "{self.layer}_label" ON "{self.layer}" ("label")')
+        ds = None
+
+
 def clean(tile, tiler_parameters, parameters):
     cleaned = blobify(tile, parameters.min_blob_size, tiler_parameters.debug)
     if tiler_parameters.debug:
@@ -33,39 +172,85 @@ def clean(tile, tiler_parameters, parameters):
     return cleaned
 
 
-def generate_simplify_func(meters_per_pixel, simplification_pixel_window):
-    tolerance = meters_per_pixel * simplification_pixel_window
-
-    def simplify(segment):
-        # Simplification will turn rings into what are effectively points.
-        # We cut the ring in half to provide simplification
-        # with non-ring segments instead.
-        if segment.is_ring:
-            assert len(segment.coords) >= 3
-            midpoint_idx = len(segment.coords) // 2
-            segment1 = LineString(segment.coords[:midpoint_idx+1])
-            segment2 = LineString(segment.coords[midpoint_idx:])
-            simplified1 = simplify_geometry(segment1, tolerance)
-            simplified2 = simplify_geometry(segment2, tolerance)
-            coords = list(simplified1.coords)[:-1] + list(simplified2.coords)
-            simplified = LineString(coords)
-        else:
-            simplified = simplify_geometry(segment, tolerance)
-        return simplified
-    return simplify
+def simplify_segments(segments, tolerance):
+    # Simplify an array of segments with a single shapely call.
+    # Simplification will turn rings into what are effectively points.
+    # We cut each ring in half to provide simplification
+    # with non-ring segments instead, then join the halves back up.
+    segments = np.asarray(segments, dtype=object)
+    include_z = bool(shapely.has_z(segments).any())
+    coords, index = shapely.get_coordinates(
+        segments, include_z=include_z, return_index=True
+    )
+    counts = np.bincount(index, minlength=len(segments))
+    starts = np.cumsum(counts) - counts
+    ends = starts + counts
+    rings = shapely.is_ring(segments)
+    assert (counts[rings] >= 3).all()
+    midpoints = starts + counts // 2
 
+    # each segment is one piece, or two halves sharing the ring's midpoint,
+    # ordered by segment then half
+    owners = np.concatenate([np.arange(len(segments)), np.nonzero(rings)[0]])
+    halves = np.concatenate(
+        [np.zeros(len(segments), dtype=int), np.ones(rings.sum(), dtype=int)]
+    )
+    piece_starts = np.concatenate([starts, midpoints[rings]])
+    piece_ends = np.concatenate([np.where(rings, midpoints + 1, ends), ends[rings]])
+    order = np.lexsort((halves, owners))
+    owners, halves = owners[order], halves[order]
+    piece_starts, piece_ends = piece_starts[order], piece_ends[order]
 
-def vectorize(tile, tiler_parameters, parameters):
-    simplify = generate_simplify_func(
-        parameters.meters_per_pixel,
-        parameters.simplification_pixel_window,
+    # gather the coordinates of the pieces from the offsets
+    lengths = piece_ends - piece_starts
+    offsets = np.cumsum(lengths) - lengths
+    gather = np.arange(lengths.sum()) + np.repeat(piece_starts - offsets, lengths)
+    pieces = shapely.linestrings(
+        coords[gather], indices=np.repeat(np.arange(len(lengths)), lengths)
+    )
+    # each piece is simplified preserving topology, exactly as the per-segment
+    # simplification did, but in one call instead of one per segment
+    simplified = shapely.simplify(pieces, tolerance, preserve_topology=True)
+
+    # join the halves, dropping the first half's copy of the midpoint
+    coords, index = shapely.get_coordinates(
+        simplified, include_z=include_z, return_index=True
+    )
+    last = np.cumsum(np.bincount(index, minlength=len(pieces))) - 1
+    keep = np.ones(len(coords), dtype=bool)
+    keep[last[(halves == 0) & rings[owners]]] = False
+    return shapely.linestrings(coords[keep], indices=owners[index[keep]])
+
+
+def simplify_tile_segments(vector_builder, tolerance):
+    # VectorBuilder hands run_per_segment one segment at a time. The first pass
+    # only collects the tile's segments, which are simplified in one batch, and
+    # the second pass swaps each segment for its simplified version.
+    segments = []
+
+    def collect(segment):
+        segments.append(segment)
+        return segment
+
+    vector_builder.run_per_segment(collect)
+    if len(segments) == 0:
+        return
+
+    segments = np.array(segments, dtype=object)
+    simplified = dict(
+        zip(shapely.to_wkb(segments), simplify_segments(segments, tolerance))
     )
+    vector_builder.run_per_segment(lambda segment: simplified[segment.wkb])
+
+
+def vectorize(tile, tiler_parameters, parameters):
+    tolerance = parameters.meters_per_pixel * parameters.simplification_pixel_window
     vector_builder = VectorBuilder(
         tile,
         tiler_parameters.transform,
         tiler_parameters.debug,
     )
-    vector_builder.run_per_segment(simplify)
+    simplify_tile_segments(vector_builder, tolerance)
     vector_builder.rebuild()
     simplified_polygons, labels = vector_builder.get_result()
 
@@ -73,9 +258,7 @@ def vectorize(tile, tiler_parameters, parameters):
         cmap = viz.generate_color_map(labels)
         viz.show_polygons(simplified_polygons, labels, color_map=cmap)
 
-    gdf = gpd.GeoDataFrame(geometry=simplified_polygons)
-    gdf['label'] = labels
-    return gdf
+    return np.array(simplified_polygons, dtype=object), np.array(labels)
 
 
 def process_tile(tile_constraints, tiler_parameters, parameters):
@@ -88,12 +271,15 @@ def process_tile(tile_constraints, tiler_parameters, parameters):
     by1 = min(start_y+height+buffer, tiler_parameters.endy)
 
     if bx1 - bx0 <= 2 * buffer or by1 - by0 <= 2 * buffer:
-        return gpd.GeoDataFrame()
+        return np.array([], dtype=object), np.array([])
 
-    tile_raster = tiler_parameters.data[bx0:bx1, by0:by1]
+    if isinstance(tiler_parameters.data, SharedRaster):
+        tile_raster = tiler_parameters.data.window(bx0, bx1, by0, by1)
+    else:
+        tile_raster = tiler_parameters.data[bx0:bx1, by0:by1]
     cleaned = clean(tile_raster, tiler_parameters, parameters)
     unbuffered = cleaned[buffer:-buffer, buffer:-buffer]
-    gdf = vectorize(
+    polygons, labels = vectorize(
         unbuffered,
         tiler_parameters,
         parameters,
@@ -102,12 +288,7 @@ def process_tile(tile_constraints, tiler_parameters, parameters):
     # in physical space, x and y are reversed
     shift_x = (by0 + buffer) * parameters.meters_per_pixel
     shift_y = -((bx0 + buffer) * parameters.meters_per_pixel)
-    gdf['geometry'] = gdf['geometry'].apply(
-        lambda geom: translate(geom, xoff=shift_x, yoff=shift_y)
-    )
-    gdf.crs = tiler_parameters.crs
-    gdf.to_file(os.path.join(
-        tiler_parameters.temp_dir,
-        f"tile-{start_x}-{start_y}.shp",
-    ))
-    return gdf
+    polygons = shapely.transform(polygons, lambda coords: coords + [shift_x, shift_y])
+
+    # the polygons go back to the tiler's TileWriter as WKB
+    return shapely.to_wkb(polygons), labels
@@ -0,0 +1,131 @@
+import click
+import os
+import threading
+
+import numpy as np
+import rasterio
+
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.windows import Window
+from tqdm import tqdm
+
+# size of the output's tiles
+BLOCK_SIZE = 512
+# rough width and height in source pixels of the windows resampled at a time
+SOURCE_BLOCK_SIZE = 2048
+
+
+def block_mode(data, factor, nodata):
+    # the most common value of each factor x factor block of data, ignoring
+    # nodata. blocks that are all nodata are nodata
+    rows, cols = data.shape[0] // factor, data.shape[1] // factor
+    blocks = data.reshape(rows, factor, cols, factor).transpose(0, 2, 1, 3)
+    blocks = np.sort(blocks.reshape(rows * cols, factor * factor), axis=1)
+
+    # the length of the run of equal values up to each sorted value. a run's
+    # last value has its full length, and the first longest run wins ties
+    positions = np.arange(blocks.shape[1])
+    starts = np.zeros(blocks.shape, dtype=np.intp)
+    starts[:, 1:] = np.where(blocks[:, 1:] != blocks[:, :-1], positions[1:], 0)
+    np.maximum.accumulate(starts, axis=1, out=starts)
+    run_lengths = positions - starts + 1
+    if nodata is not None:
+        run_lengths[blocks == nodata] = 0
+
+    best = run_lengths.argmax(axis=1)
+    index = np.arange(len(blocks))
+    mode = blocks[index, best]
+    if nodata is not None:
+        mode[run_lengths[index, best] == 0] = nodata
+    return mode.reshape(rows, cols)
+
+
+def resample_level(input_file, output_file, factor, workers):
+    # write a copy of the class raster with pixels factor times as large, each
+    # taking the most common class of the pixels it covers that aren't nodata
+    with rasterio.open(input_file) as src:
+        width = -(-src.width // factor)
+        height = -(-src.height // factor)
+        profile = src.profile.copy()
+        profile.update(
+            width=width,
+            height=height,
+            transform=src.transform * src.transform.scale(factor),
+            tiled=True,
+            blockxsize=BLOCK_SIZE,
+            blockysize=BLOCK_SIZE,
+            compress="deflate",
+            BIGTIFF="IF_SAFER",
+        )
+
+        with rasterio.open(output_file, "w", **profile) as dst:
+            read_lock = threading.Lock()
+            write_lock = threading.Lock()
+
+            def resample_block(window):
+                # the last row and column of pixels can run off the edge of
+                # the source, which is read as nodata
+                source = Window(
+                    window.col_off * factor,
+                    window.row_off * factor,
+                    window.width * factor,
+                    window.height * factor,
+                )
+                with read_lock:
+                    data = src.read(
+                        1, window=source, boundless=True, fill_value=src.nodata
+                    )
+                data = block_mode(data, factor, src.nodata)
+                with write_lock:
+                    dst.write(data, 1, window=window)
+
+            # windows are whole output tiles, so no tile is written twice or
+            # by two threads. at large factors that's a tile of output pixels,
+            # whatever it covers of the source
+            size = max(1, round(SOURCE_BLOCK_SIZE / factor / BLOCK_SIZE)) * BLOCK_SIZE
+            windows = [
+                Window(col, row, min(size, width - col), min(size, height - row))
+                for row in range(0, height, size)
+                for col in range(0, width, size)
+            ]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for _ in tqdm(
+                    executor.map(resample_block, windows), total=len(windows)
+                ):
+                    pass
+
+
+@click.command()
+@click.option(
+    "--input-file",
+    type=click.Path(file_okay=True, dir_okay=False),
+    help="The landcover class raster",
+    default="data/temp/filtered.tif",
+)
+@click.option(
+    "--output-dir",
+    help="Where to write the resampled rasters",
+    default="data/temp",
+)
+@click.option(
+    "--factors",
+    help="Comma separated list of how many times larger the pixels of each level are",
+    default="4,16",
+)
+@click.option(
+    "--workers",
+    default=os.cpu_count(),
+    help="Number of threads resampling blocks",
+)
+def cli(input_file, output_dir, factors, workers):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    for factor in [int(x) for x in factors.split(",")]:
+        output_file = os.path.join(output_dir, f"landcover-{factor}x.tif")
+        print(f"Resampling to {factor}x pixels at {output_file}...")
+        resample_level(input_file, output_file, factor, workers)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,243 @@
+import click
+import fiona
+import multiprocessing
+import os
+import shutil
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+import sqlite3
+
+from shapely.geometry import LineString
+from tqdm import tqdm
+
+# fraction of a pixel a polygon's edge can be off a seam and still be on it
+SEAM_TOLERANCE = 0.001
+
+
+def seam_index(values, origin, step, count):
+    # the index of the interior seam each value lies on, or -1. seam k is at
+    # origin + k * step, and seams 0 and count are the edges of the raster
+    k = np.rint((values - origin) / step)
+    on_seam = np.abs(values - (origin + k * step)) <= abs(step) * SEAM_TOLERANCE
+    return np.where(on_seam & (k > 0) & (k < count), k, -1).astype(int)
+
+
+def seam_pairs(geometries, labels, before, after, seams, tolerance):
+    # pairs of polygons with the same label sharing an edge along a seam. before
+    # holds the seam each polygon's far edge is on, after the seam its near edge
+    # is on, so only polygons next to the same seam are compared
+    pairs = []
+    for k, seam in seams:
+        left = np.nonzero(before == k)[0]
+        right = np.nonzero(after == k)[0]
+        if len(left) == 0 or len(right) == 0:
+            continue
+
+        # the parts of the seam each polygon's boundary runs along
+        left_edges = shapely.intersection(shapely.boundary(geometries[left]), seam)
+        right_edges = shapely.intersection(shapely.boundary(geometries[right]), seam)
+
+        tree = shapely.STRtree(right_edges)
+        i, j = tree.query(left_edges, predicate="intersects")
+        same_label = labels[left[i]] == labels[right[j]]
+        i, j = i[same_label], j[same_label]
+        shared = shapely.length(shapely.intersection(left_edges[i], right_edges[j]))
+        keep = shared > tolerance
+        pairs.extend(zip(left[i[keep]], right[j[keep]]))
+    return pairs
+
+
+def find_root(parents, i):
+    # find the root of i's set, flattening the path to it
+    root = i
+    while parents[root] != root:
+        root = parents[root]
+    while parents[i] != root:
+        parents[i], i = root, parents[i]
+    return root
+
+
+def find_groups(pairs):
+    # the connected groups of polygons joined by the pairs
+    parents = {}
+    for i, j in pairs:
+        parents.setdefault(i, i)
+        parents.setdefault(j, j)
+        root_i, root_j = find_root(parents, i), find_root(parents, j)
+        if root_i != root_j:
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups = {}
+    for i in parents:
+        groups.setdefault(find_root(parents, i), []).append(i)
+    return [sorted(group) for group in groups.values()]
+
+
+def dissolve(geometries):
+    return shapely.unary_union(geometries)
+
+
+def read_seam_polygons(input_file, layer, seams, tolerance):
+    # read only the polygons in a thin strip along each seam, through the
+    # geopackage's spatial index, keyed by their feature ids
+    strips = []
+    for _, seam in seams:
+        min_x, min_y, max_x, max_y = seam.bounds
+        strips.append(
+            gpd.read_file(
+                input_file,
+                layer=layer,
+                bbox=(
+                    min_x - tolerance,
+                    min_y - tolerance,
+                    max_x + tolerance,
+                    max_y + tolerance,
+                ),
+                fid_as_index=True,
+            )
+        )
+    polygons = pd.concat(strips)
+    return polygons[~polygons.index.duplicated()]
+
+
+@click.command()
+@click.option(
+    "--input-file",
+    help="The polygonized landcover",
+    default="data/temp/combined.gpkg",
+)
+@click.option(
+    "--output-file",
+    help="The output geopackage, which can be the input to stitch it in place",
+    default="data/temp/stitched.gpkg",
+)
+@click.option(
+    "--raster-file",
+    help="The raster the polygons were made from, for the grid of tiles",
+    default="data/temp/filtered.tif",
+)
+@click.option(
+    "--tile-size",
+    help="Width and height in pixels of the tiles the raster was polygonized in",
+    default=1000,
+)
+@click.option(
+    "--label-field",
+    help="The property of the polygons with their landcover value",
+    default="label",
+)
+@click.option(
+    "--workers", default=multiprocessing.cpu_count(), help="Number of workers to use"
+)
+def cli(input_file, output_file, raster_file, tile_size, label_field, workers):
+    # make the path to the output directory if it doesn't exist
+    output_dir = os.path.dirname(output_file)
+    if output_dir != "" and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    with rasterio.open(raster_file) as src:
+        transform = src.transform
+        cols = -(-src.width // tile_size)
+        rows = -(-src.height // tile_size)
+    left, top = transform.c, transform.f
+    right, bottom = transform * (cols * tile_size, rows * tile_size)
+    step_x, step_y = transform.a * tile_size, transform.e * tile_size
+
+    vertical = [
+        (k, LineString([(left + k * step_x, top), (left + k * step_x, bottom)]))
+        for k in range(1, cols)
+    ]
+    horizontal = [
+        (k, LineString([(left, top + k * step_y), (right, top + k * step_y)]))
+        for k in range(1, rows)
+    ]
+
+    if os.path.abspath(output_file) != os.path.abspath(input_file):
+        shutil.copyfile(input_file, output_file)
+    if len(vertical) + len(horizontal) == 0:
+        print("The raster is a single tile, there's nothing to stitch")
+        return
+
+    # polygons are clipped to their tile, so a polygon is on a seam if its
+    # bounds are. only the polygons along the seams are read, everything else
+    # is left where it is
+    print("Loading polygons along tile seams...")
+    layer = fiona.listlayers(input_file)[0]
+    gdf = read_seam_polygons(
+        input_file, layer, vertical + horizontal, abs(step_x) * SEAM_TOLERANCE
+    )
+    fids = gdf.index.to_numpy()
+    gdf = gdf.reset_index(drop=True)
+    geometries = gdf.geometry.values.to_numpy()
+    labels = gdf[label_field].to_numpy()
+    bounds = shapely.bounds(geometries)
+
+    min_x_seam = seam_index(bounds[:, 0], left, step_x, cols)
+    max_x_seam = seam_index(bounds[:, 2], left, step_x, cols)
+    # rows go down, so a polygon's top is on the seam above it
+    max_y_seam = seam_index(bounds[:, 3], top, step_y, rows)
+    min_y_seam = seam_index(bounds[:, 1], top, step_y, rows)
+    on_seam = (
+        (min_x_seam >= 0) | (max_x_seam >= 0) | (min_y_seam >= 0) | (max_y_seam >= 0)
+    )
+    print(f"{on_seam.sum()} polygons are on a tile seam")
+
+    print("Finding polygons across seams...")
+    tolerance = abs(transform.a) * SEAM_TOLERANCE
+    pairs = seam_pairs(
+        geometries, labels, max_x_seam, min_x_seam, vertical, tolerance
+    ) + seam_pairs(geometries, labels, min_y_seam, max_y_seam, horizontal, tolerance)
+    groups = find_groups(pairs)
+    print(f"Dissolving {len(groups)} groups of polygons across seams...")
+
+    with multiprocessing.Pool(workers) as pool:
+        dissolved = list(
+            tqdm(
+                pool.imap(
+                    dissolve,
+                    (geometries[group] for group in groups),
+                    chunksize=64,
+                ),
+                total=len(groups),
+            )
+        )
+
+    # each group is swapped for its dissolved polygon, keeping the first
+    # polygon's properties
+    stitched = gpd.GeoDataFrame(
+        gdf.iloc[[group[0] for group in groups]].drop(columns="geometry"),
+        geometry=dissolved,
+        crs=gdf.crs,
+    ).explode(index_parts=False, ignore_index=True)
+
+    print(
+        f"Replacing {sum(len(group) for group in groups)} polygons with {len(stitched)}..."
+    )
+    # new features go through GDAL, which keeps the spatial index up to date.
+    # deleting rows only needs the index's plain SQL trigger, so the grouped
+    # polygons are deleted by feature id directly
+    if len(stitched) > 0:
+        stitched.to_file(output_file, layer=layer, driver="GPKG", mode="a")
+    connection = sqlite3.connect(output_file)
+    fid_column = next(
+        row[1] for row in connection.execute(f'PRAGMA table_info("{layer}");') if row[5]
+    )
+    connection.executemany(
+        f'DELETE FROM "{layer}" WHERE "{fid_column}" = ?;',
+        [(int(fids[i]),) for group in groups for i in group],
+    )
+    # index the labels, so their distinct values can be found without reading
+    # every polygon
+    connection.execute(
+        f'CREATE INDEX IF NOT EXISTS "{layer}_{label_field}" ON "{layer}" ("{label_field}");'
+    )
+    connection.commit()
+    connection.close()
+
+
+if __name__ == "__main__":
+    cli()
@@ -2,19 +2,84 @@
 
 mkdir -p data/output
 
-echo -e "\nConverting to GeoJSON...\n"
+# the levels of detail, coarsest first, as the resampling factor of each level
+# and the first zoom it's tiled for. each level is tiled up to the zoom before
+# the next one's, and factor 1 is the full resolution polygons
+LEVELS=(${LEVELS:-16:1 4:9 1:12})
+MAX_ZOOM=16
 
-ogr2ogr -f GeoJSONSeq data/temp/landcover.geojsons data/temp/combined.gpkg
+level_file() {
+    # the polygons of a level, using the ones stitched across tile seams if
+    # they've been made
+    local suffix=""
+    if [ "$1" != 1 ]; then
+        suffix="-$1x"
+    fi
+    for name in stitched combined; do
+        if [ -f "data/temp/$name$suffix.gpkg" ]; then
+            echo "data/temp/$name$suffix.gpkg"
+            return
+        fi
+    done
+}
 
-echo -e "\nTiling dataset...\n"
+tile_band() {
+    # tile a geojsons file for a band of zooms, with any extra tippecanoe options
+    tippecanoe -Z"$2" -z"$3" -P -o "$4" \
+            --no-simplification-of-shared-nodes \
+            --hilbert \
+            --visvalingam \
+            -l landcover \
+            "${@:5}" \
+            "$1" \
+            --force
+}
 
-tippecanoe -Z1 -z16 -P -o data/output/landcover.pmtiles \
-        --no-simplification-of-shared-nodes \
-        --hilbert \
-        --visvalingam \
-        --maximum-tile-bytes=350000 \
-        -l landcover \
-        data/temp/landcover.geojsons \
-        --force
+# the resampled levels are only used if every one of them has been polygonized
+for level in "${LEVELS[@]}"; do
+    if [ -z "$(level_file "${level%%:*}")" ]; then
+        LEVELS=()
+        break
+    fi
+done
+
+if [ ${#LEVELS[@]} -le 1 ]; then
+    echo -e "\nConverting to GeoJSON...\n"
+
+    ogr2ogr -f GeoJSONSeq data/temp/landcover.geojsons "$(level_file 1)"
+
+    echo -e "\nTiling dataset...\n"
+
+    # without coarser levels, the low zooms only fit by dropping polygons
+    tile_band data/temp/landcover.geojsons 1 $MAX_ZOOM data/output/landcover.pmtiles \
+            --maximum-tile-bytes=350000
+else
+    BANDS=()
+    for i in "${!LEVELS[@]}"; do
+        factor=${LEVELS[$i]%%:*}
+        min_zoom=${LEVELS[$i]#*:}
+        next=${LEVELS[$((i + 1))]}
+        max_zoom=$MAX_ZOOM
+        if [ -n "$next" ]; then
+            max_zoom=$((${next#*:} - 1))
+        fi
+
+        echo -e "\nTiling ${factor}x level for zooms $min_zoom-$max_zoom...\n"
+
+        ogr2ogr -f GeoJSONSeq "data/temp/landcover-${factor}x.geojsons" "$(level_file "$factor")"
+        # each level's pixels are sized for its zooms, so its tiles fit
+        # without dropping polygons
+        tile_band "data/temp/landcover-${factor}x.geojsons" "$min_zoom" "$max_zoom" \
+                "data/temp/landcover-z$min_zoom-$max_zoom.pmtiles"
+        BANDS+=("data/temp/landcover-z$min_zoom-$max_zoom.pmtiles")
+    done
+
+    echo -e "\nJoining zoom levels...\n"
+
+    tile-join -o data/output/landcover.pmtiles \
+            --no-tile-size-limit \
+            "${BANDS[@]}" \
+            --force
+fi
 
 echo -e "\n\nDone, created: \ndata/output/landcover.pmtiles\n"
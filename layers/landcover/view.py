@@ -8,9 +8,9 @@ import utils.visualization as viz
 @click.command()
 @click.option(
     '--file',
-    default="data/temp/combined.shp",
+    default="data/temp/combined.gpkg",
     type=str,
-    help='Shapefile to view',
+    help='Polygons to view',
 )
 def cli(file):
     gdf = gpd.read_file(file)
@@ -11,34 +11,17 @@ fi
 echo "SNOW PIPELINE: Quantizing raster..."
 
 python quantize.py \
-    --input-file="data/sources/snow-conus.tif" \
+    --input-file="data/sources/snodas.tar" \
     --output-file="data/temp/snow-quantized.tif" \
     --bin-size=12 \
     --bbox="$1" 
 
-echo "SNOW PIPELINE: Polygonizing raster..."
+# polygonize and tile the raster. after the first run, only the parts of the
+# raster that changed since the previous run are polygonized and retiled
+echo "SNOW PIPELINE: Updating polygons and tiles..."
 
-geopolygonize \
+python update_snow.py \
     --input-file="data/temp/snow-quantized.tif" \
-    --output-file="data/temp/snow-contours.gpkg" \
-    --simplification-pixel-window=1 \
-    --min-blob-size=12 \
-    --smoothing-iterations=1 \
-    --label-name="depth"
-
-echo "SNOW PIPELINE: Cleaning polygons..."
-
-ogr2ogr \
-    -f GPKG \
-    data/temp/snow-final.gpkg \
-    data/temp/snow-contours.gpkg \
-    -nln snow \
-    -where "depth != 0"
-
-echo "SNOW PIPELINE: Tiling..."
-
-bash tile_snow.sh \
-    data/temp/snow-final.gpkg \
-    data/output/snow.pmtiles
+    --output-file="data/output/snow.pmtiles"
 
 echo "SNOW PIPELINE: Done."
\ No newline at end of file
@@ -1,14 +1,97 @@
+import os
+import threading
+
 import rasterio
 import click
 import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.windows import Window
 from tqdm import tqdm
 
+import snodas
+
+# values are in milimeters, convert to inches
+MM_TO_INCHES = 0.0393701
+# rows of the raster read, quantized and written at a time
+BLOCK_ROWS = 512
+
+
+def quantize_values(values, thresholds, nodata):
+    # convert each value to its bin's value: the first threshold at or above it,
+    # or the last threshold for values above that. values in the 0 bin and
+    # nodata values become 0
+    data = np.where(values == nodata, 0, values) * MM_TO_INCHES
+    if len(thresholds) == 0:
+        return np.zeros(values.shape, dtype=np.float64)
+
+    bin_index = np.digitize(data, thresholds, right=True)
+    return thresholds[np.minimum(bin_index, len(thresholds) - 1)]
+
+
+def make_lookup_table(dtype, thresholds, nodata):
+    # every value of a small integer type can be quantized up front, so blocks
+    # are binned with a single table lookup
+    info = np.iinfo(dtype)
+    values = np.arange(info.min, info.max + 1, dtype=dtype)
+    return quantize_values(values, thresholds, nodata).astype(dtype)
+
+
+def make_blocks(width, height):
+    return [
+        Window(0, row, width, min(BLOCK_ROWS, height - row))
+        for row in range(0, height, BLOCK_ROWS)
+    ]
+
+
+def offset_window(window, block):
+    # the source window of a block of the (possibly cropped) output
+    return Window(
+        window.col_off + block.col_off,
+        window.row_off + block.row_off,
+        block.width,
+        block.height,
+    )
+
+
+def open_geotiff(input_file, bbox):
+    # returns a function reading blocks of the cropped raster, its meta and a
+    # function closing it
+    src = rasterio.open(input_file)
+    meta = src.meta.copy()
+    if bbox:
+        window = snodas.snap_window(bbox, src.transform, src.width, src.height)
+        # set the meta based on new bounding box
+        meta["height"] = window.height
+        meta["width"] = window.width
+        meta["transform"] = rasterio.windows.transform(window, src.transform)
+    else:
+        window = Window(0, 0, src.width, src.height)
+
+    read_lock = threading.Lock()
+
+    def read_block(block):
+        with read_lock:
+            return src.read(1, window=offset_window(window, block))
+
+    return read_block, meta, src.close
+
+
+def open_snodas(input_file, bbox):
+    # the cropped grid is read into memory straight from the SNODAS archive
+    data, transform, _ = snodas.read_snodas(input_file, bbox)
+
+    def read_block(block):
+        return data[block.row_off : block.row_off + block.height]
+
+    return read_block, snodas.make_meta(data, transform), lambda: None
+
 
 @click.command()
 @click.option(
     "--input-file",
-    help="The input geotiff",
-    default="data/sources/snow-conus.tif",
+    help="The input geotiff, or SNODAS tar archive or snow depth file",
+    default="data/sources/snodas.tar",
 )
 @click.option(
     "--output-file",
@@ -25,69 +108,61 @@ from tqdm import tqdm
     help="The bounding box to trim the output",
     default=None,
 )
-def cli(input_file, output_file, bin_size, bbox):
-    with rasterio.open(input_file) as src:
-
-        if bbox:
-            # clip the data to bounding box
-            x_min, y_min, x_max, y_max = bbox.split(",")
-            x_min, y_min, x_max, y_max = (
-                float(x_min),
-                float(y_min),
-                float(x_max),
-                float(y_max),
-            )
-            window = rasterio.windows.from_bounds(
-                x_min, y_min, x_max, y_max, src.transform
-            )
-            data = src.read(1, window=window)
-        else:
-            data = src.read(1)
+@click.option(
+    "--workers",
+    default=os.cpu_count(),
+    help="Number of threads quantizing blocks",
+)
+def cli(input_file, output_file, bin_size, bbox, workers):
+    if snodas.is_snodas(input_file):
+        read_block, meta, close = open_snodas(input_file, bbox)
+    else:
+        read_block, meta, close = open_geotiff(input_file, bbox)
+
+    nodata = meta["nodata"]
+    blocks = make_blocks(meta["width"], meta["height"])
 
-        # set nodata values to 0
-        data[data == src.meta["nodata"]] = 0
-        # values are in milimeters, convert to inches
-        data = data * 0.0393701
+    def block_max(block):
+        data = read_block(block)
+        return np.max(np.where(data == nodata, 0, data))
 
+    try:
         print(f"SNOW PIPELINE/QUANTIZE: Creating bins...")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            max_value = max(executor.map(block_max, blocks))
+
         # divide the range into bins
-        thresholds = np.arange(0, np.max(data), bin_size)
-        # Apply quantization thresholds
-        quantized_data = np.digitize(data, thresholds, right=True)
-        out_data = np.zeros_like(data)
+        thresholds = np.arange(0, max_value * MM_TO_INCHES, bin_size)
+
+        dtype = np.dtype(meta["dtype"])
+        if dtype.kind in "iu" and dtype.itemsize <= 2:
+            lookup_table = make_lookup_table(dtype, thresholds, nodata)
+            offset = np.iinfo(dtype).min
+
+            def quantize(data):
+                return lookup_table[data.astype(np.int32) - offset]
+
+        else:
+
+            def quantize(data):
+                return quantize_values(data, thresholds, nodata).astype(dtype)
 
-        rows, columns = quantized_data.shape
-        print(f"SNOW PIPELINE/QUANTIZE: Binning pixels to {bin_size}in bins...")
-        # convert each value in the raster to its bin's value
-        for j in tqdm(range(columns)):
-            for i in range(rows):
-                bin_index = quantized_data[i, j]
-
-                if data[i, j] == src.meta["nodata"]:
-                    bin_value = src.meta["nodata"]
-                if bin_index == len(thresholds):
-                    # value greater than last threshold gets set to last threshold
-                    bin_value = thresholds[-1]
-                else:
-                    bin_value = thresholds[bin_index]
-                    # 0 values get set to no data
-                    if bin_value == 0:
-                        bin_value = src.meta["nodata"]
-
-                out_data[i, j] = bin_value
-
-        meta = src.meta.copy()
-        out_data[out_data == src.meta["nodata"]] = 0
         meta["nodata"] = 0
-        # set the meta based on new bounding box
-        if bbox:
-            meta["height"] = out_data.shape[0]
-            meta["width"] = out_data.shape[1]
-            meta["transform"] = rasterio.windows.transform(window, src.transform)
 
-        print(f"SNOW PIPELINE/QUANTIZE: Writing output...")
+        print(f"SNOW PIPELINE/QUANTIZE: Binning pixels to {bin_size}in bins...")
         with rasterio.open(output_file, "w", **meta) as dst:
-            dst.write(out_data, 1)
+            write_lock = threading.Lock()
+
+            def quantize_block(block):
+                out_data = quantize(read_block(block))
+                with write_lock:
+                    dst.write(out_data, 1, window=block)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for _ in tqdm(executor.map(quantize_block, blocks), total=len(blocks)):
+                    pass
+    finally:
+        close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+import fnmatch
+import gzip
+import json
+import math
+import os
+import tarfile
+
+import click
+import numpy as np
+import rasterio
+
+from rasterio.transform import from_bounds
+from rasterio.windows import Window
+
+# see https://nsidc.org/sites/default/files/g02158-v001-userguide_2_1.pdf for naming convention
+# region: US
+# model: SSMV
+# type: snow model output
+# product: snow depth
+# data: integral through the snowpack
+# time: 1 hour snapshot
+# zz_ssmv11036tS__T0001TTNATSyyyymmddhhIP00Z.dat.gz
+SNOW_DEPTH_MEMBER = "zz_ssmv11036tS__T0001TTNATS*.dat.gz"
+
+# the unmasked grid is 8192 x 4096 big-endian int16 values covering these bounds
+# https://nsidc.org/data/user-resources/help-center/how-do-i-convert-snodas-binary-files-geotiff-or-netcdf
+WIDTH = 8192
+HEIGHT = 4096
+DTYPE = np.dtype(">i2")
+BOUNDS = (-130.51666666666667, 24.1, -62.25, 58.23333333333333)
+TRANSFORM = from_bounds(*BOUNDS, WIDTH, HEIGHT)
+NODATA = -9999
+CRS = "+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs"
+
+# fraction of a pixel a bounding box edge can be off a pixel edge and still be
+# treated as on it
+EDGE_TOLERANCE = 1e-6
+
+# rows decompressed at a time while streaming the grid out of the archive
+CHUNK_ROWS = 256
+
+
+def is_snodas(input_file):
+    return input_file.endswith((".tar", ".dat", ".dat.gz"))
+
+
+def snap_window(bbox, transform, width, height):
+    # the window of whole pixels covering the bounding box. edges within a
+    # rounding error of a pixel edge are snapped to it rather than past it
+    x_min, y_min, x_max, y_max = (float(v) for v in bbox.split(","))
+    bounds = rasterio.windows.from_bounds(x_min, y_min, x_max, y_max, transform)
+    col0 = max(math.floor(bounds.col_off + EDGE_TOLERANCE), 0)
+    row0 = max(math.floor(bounds.row_off + EDGE_TOLERANCE), 0)
+    col1 = min(math.ceil(bounds.col_off + bounds.width - EDGE_TOLERANCE), width)
+    row1 = min(math.ceil(bounds.row_off + bounds.height - EDGE_TOLERANCE), height)
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+
+def snow_depth_member(tar):
+    # select the last snow depth file (latest if there are multiple)
+    members = sorted(
+        (
+            member
+            for member in tar.getmembers()
+            if fnmatch.fnmatch(os.path.basename(member.name), SNOW_DEPTH_MEMBER)
+        ),
+        key=lambda member: member.name,
+    )
+    if not members:
+        raise click.ClickException("No snowcover file with correct type found")
+    return members[-1]
+
+
+def parse_timestamp(name):
+    # get the date and time from the yyyymmddhhHP001 portion of the filename
+    stamp = os.path.basename(name).split(".")[0][-15:]
+    return {
+        "year": stamp[0:4],
+        "month": stamp[4:6],
+        "day": stamp[6:8],
+        "hour": stamp[8:10],
+    }
+
+
+def read_rows(f, window):
+    # read the window's rows out of a stream of the full grid, decompressing a
+    # chunk of rows at a time and only keeping the window's columns
+    row_bytes = WIDTH * DTYPE.itemsize
+    data = np.empty((window.height, window.width), dtype=np.int16)
+
+    row = 0
+    while row < window.row_off + window.height:
+        rows = min(CHUNK_ROWS, window.row_off + window.height - row)
+        chunk = f.read(rows * row_bytes)
+        if len(chunk) != rows * row_bytes:
+            raise click.ClickException("SNODAS grid is truncated")
+
+        first = max(window.row_off, row)
+        if first < row + rows:
+            grid = np.frombuffer(chunk, dtype=DTYPE).reshape(rows, WIDTH)
+            data[first - window.row_off : row + rows - window.row_off] = grid[
+                first - row :, window.col_off : window.col_off + window.width
+            ]
+        row += rows
+
+    return data
+
+
+def read_snodas(input_file, bbox=None, window=None):
+    # read the snow depth grid from a SNODAS tar archive, or a .dat or .dat.gz
+    # file extracted from one, cropped to the bounding box or window. returns
+    # the grid as native int16 values, its transform and the time of the snapshot
+    if window is None and bbox:
+        window = snap_window(bbox, TRANSFORM, WIDTH, HEIGHT)
+    elif window is None:
+        window = Window(0, 0, WIDTH, HEIGHT)
+    transform = rasterio.windows.transform(window, TRANSFORM)
+
+    if input_file.endswith(".dat"):
+        grid = np.memmap(input_file, dtype=DTYPE, mode="r", shape=(HEIGHT, WIDTH))
+        data = grid[
+            window.row_off : window.row_off + window.height,
+            window.col_off : window.col_off + window.width,
+        ].astype(np.int16)
+        return data, transform, parse_timestamp(input_file)
+
+    if input_file.endswith(".dat.gz"):
+        with gzip.open(input_file, "rb") as f:
+            return read_rows(f, window), transform, parse_timestamp(input_file)
+
+    with tarfile.open(input_file) as tar:
+        member = snow_depth_member(tar)
+        with gzip.GzipFile(fileobj=tar.extractfile(member)) as f:
+            return read_rows(f, window), transform, parse_timestamp(member.name)
+
+
+def make_meta(data, transform):
+    height, width = data.shape
+    return {
+        "driver": "GTiff",
+        "dtype": "int16",
+        "nodata": NODATA,
+        "width": width,
+        "height": height,
+        "count": 1,
+        "crs": CRS,
+        "transform": transform,
+    }
+
+
+@click.command()
+@click.option(
+    "--input-file",
+    help="The SNODAS tar archive, or a .dat or .dat.gz snow depth file",
+    default="data/sources/snodas.tar",
+)
+@click.option(
+    "--meta-file",
+    help="Where to save the date and time of the data",
+    default="data/output/snow-meta.json",
+)
+@click.option(
+    "--output-file",
+    help="Also save the snow depth as a GeoTIFF",
+    default=None,
+)
+@click.option(
+    "--bbox",
+    help="The bounding box to trim the GeoTIFF",
+    default=None,
+)
+def cli(input_file, meta_file, output_file, bbox):
+    if output_file:
+        data, transform, timestamp = read_snodas(input_file, bbox)
+        with rasterio.open(output_file, "w", **make_meta(data, transform)) as dst:
+            dst.write(data, 1)
+    elif input_file.endswith(".tar"):
+        # only the member's name is needed for the timestamp
+        with tarfile.open(input_file) as tar:
+            timestamp = parse_timestamp(snow_depth_member(tar).name)
+    else:
+        timestamp = parse_timestamp(input_file)
+
+    print(
+        f"SNODAS snapshot from {timestamp['year']}-{timestamp['month']}-{timestamp['day']} {timestamp['hour']}:00"
+    )
+    with open(meta_file, "w") as f:
+        json.dump(timestamp, f)
+
+
+if __name__ == "__main__":
+    cli()
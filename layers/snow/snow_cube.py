@@ -0,0 +1,297 @@
+import json
+import os
+import zlib
+
+import click
+import numpy as np
+import rasterio
+
+from affine import Affine
+from rasterio.windows import Window
+from tqdm import tqdm
+
+import snodas
+
+# The cube is a directory holding:
+#  cube.json       the grid (size, transform, crs) and chunk size
+#  index.bin       fixed-size records, one per chunk per day, appended to daily
+#  YYYYMM.bin      the zlib compressed chunks of each month's days, appended to
+# Chunks whose pixels all have the same value aren't stored; their index record
+# has a length of 0 and the value in fill.
+INDEX_DTYPE = np.dtype(
+    [
+        ("date", "<i4"),
+        ("chunk", "<i4"),
+        ("month", "<i4"),
+        ("offset", "<i8"),
+        ("length", "<i4"),
+        ("fill", "<i2"),
+    ]
+)
+# snow depths are stored in milimeters, as in the SNODAS grids
+DTYPE = np.dtype("<i2")
+CHUNK_SIZE = 256
+
+
+def date_key(date):
+    # dates are stored as YYYYMMDD integers
+    return int(date.replace("-", ""))
+
+
+class SnowCube:
+    def __init__(self, cube_dir):
+        self.cube_dir = cube_dir
+        with open(os.path.join(cube_dir, "cube.json")) as f:
+            self.info = json.load(f)
+        self.width = self.info["width"]
+        self.height = self.info["height"]
+        self.transform = Affine(*self.info["transform"])
+        self.chunk_size = self.info["chunk_size"]
+        self.chunk_rows = -(-self.height // self.chunk_size)
+        self.chunk_cols = -(-self.width // self.chunk_size)
+        self.index_file = os.path.join(cube_dir, "index.bin")
+        self.data_files = {}
+
+    @classmethod
+    def create(cls, cube_dir, width, height, transform, crs, chunk_size=CHUNK_SIZE):
+        os.makedirs(cube_dir, exist_ok=True)
+        with open(os.path.join(cube_dir, "cube.json"), "w") as f:
+            json.dump(
+                {
+                    "width": width,
+                    "height": height,
+                    "transform": list(transform)[:6],
+                    "crs": crs,
+                    "nodata": snodas.NODATA,
+                    "chunk_size": chunk_size,
+                },
+                f,
+            )
+        open(os.path.join(cube_dir, "index.bin"), "ab").close()
+        return cls(cube_dir)
+
+    def index(self):
+        if os.path.getsize(self.index_file) == 0:
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        return np.memmap(self.index_file, dtype=INDEX_DTYPE, mode="r")
+
+    def dates(self):
+        return np.unique(self.index()["date"])
+
+    def chunk_window(self, chunk):
+        # (row0, col0, row1, col1) of a chunk in pixels
+        row, col = divmod(chunk, self.chunk_cols)
+        row0, col0 = row * self.chunk_size, col * self.chunk_size
+        return (
+            row0,
+            col0,
+            min(row0 + self.chunk_size, self.height),
+            min(col0 + self.chunk_size, self.width),
+        )
+
+    def chunks_in(self, window):
+        # the chunks overlapping a (row0, col0, row1, col1) window
+        row0, col0, row1, col1 = window
+        return [
+            row * self.chunk_cols + col
+            for row in range(row0 // self.chunk_size, -(-row1 // self.chunk_size))
+            for col in range(col0 // self.chunk_size, -(-col1 // self.chunk_size))
+        ]
+
+    def append(self, date, data):
+        # add a day's grid. days can't be replaced once they're in the cube
+        key = date_key(date)
+        if key in self.dates():
+            raise click.ClickException(f"{date} is already in the cube")
+        if data.shape != (self.height, self.width):
+            raise click.ClickException(
+                f"grid is {data.shape}, the cube is {(self.height, self.width)}"
+            )
+
+        month = key // 100
+        data_file = os.path.join(self.cube_dir, f"{month}.bin")
+        records = np.zeros(self.chunk_rows * self.chunk_cols, dtype=INDEX_DTYPE)
+        with open(data_file, "ab") as f:
+            offset = f.tell()
+            for chunk in range(len(records)):
+                row0, col0, row1, col1 = self.chunk_window(chunk)
+                values = np.ascontiguousarray(data[row0:row1, col0:col1], dtype=DTYPE)
+                record = records[chunk]
+                record["date"] = key
+                record["chunk"] = chunk
+                record["month"] = month
+
+                first = values.flat[0]
+                if (values == first).all():
+                    record["fill"] = first
+                    continue
+
+                compressed = zlib.compress(values.tobytes())
+                f.write(compressed)
+                record["offset"] = offset
+                record["length"] = len(compressed)
+                offset += len(compressed)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # the index is only written once the data is on disk, so a failed
+        # append leaves the cube as it was
+        with open(self.index_file, "ab") as f:
+            f.write(records.tobytes())
+
+    def _data(self, month):
+        if month not in self.data_files:
+            self.data_files[month] = np.memmap(
+                os.path.join(self.cube_dir, f"{month}.bin"), dtype=np.uint8, mode="r"
+            )
+        return self.data_files[month]
+
+    def read_chunk(self, record):
+        row0, col0, row1, col1 = self.chunk_window(record["chunk"])
+        shape = (row1 - row0, col1 - col0)
+        if record["length"] == 0:
+            return np.full(shape, record["fill"], dtype=DTYPE)
+        data = self._data(int(record["month"]))
+        compressed = data[record["offset"] : record["offset"] + record["length"]]
+        return np.frombuffer(zlib.decompress(compressed), dtype=DTYPE).reshape(shape)
+
+    def records(self, chunks, start, end):
+        # index records of the chunks between two dates, grouped by chunk
+        index = self.index()
+        keep = (index["date"] >= start) & (index["date"] <= end)
+        keep &= np.isin(index["chunk"], chunks)
+        selected = np.asarray(index[keep])
+        for chunk in chunks:
+            yield chunk, selected[selected["chunk"] == chunk]
+
+    def query(self, start, end=None, aggregate="max", window=None):
+        # the grid of a day, or an aggregate of the days between two dates, over
+        # a (row0, col0, row1, col1) window. only the window's chunks are read
+        start = date_key(start)
+        end = date_key(end) if end else start
+        if window is None:
+            window = (0, 0, self.height, self.width)
+        row0, col0, row1, col1 = window
+        out = np.full((row1 - row0, col1 - col0), snodas.NODATA, dtype=DTYPE)
+
+        chunks = self.chunks_in(window)
+        found = False
+        for chunk, records in tqdm(self.records(chunks, start, end), total=len(chunks)):
+            if len(records) == 0:
+                continue
+            found = True
+            days = [self.read_chunk(record) for record in records]
+            values = combine(days, aggregate)
+
+            # copy the part of the chunk inside the window
+            c_row0, c_col0, c_row1, c_col1 = self.chunk_window(chunk)
+            r0, c0 = max(c_row0, row0), max(c_col0, col0)
+            r1, c1 = min(c_row1, row1), min(c_col1, col1)
+            out[r0 - row0 : r1 - row0, c0 - col0 : c1 - col0] = values[
+                r0 - c_row0 : r1 - c_row0, c0 - c_col0 : c1 - c_col0
+            ]
+
+        if not found:
+            raise click.ClickException("No days in the cube for that date range")
+        return out
+
+
+def combine(days, aggregate):
+    # combine the same chunk of several days, ignoring nodata
+    if len(days) == 1:
+        return days[0]
+    stack = np.stack(days)
+    valid = stack != snodas.NODATA
+    count = valid.sum(axis=0)
+
+    if aggregate == "max":
+        out = np.where(valid, stack, np.iinfo(DTYPE).min).max(axis=0)
+    elif aggregate == "mean":
+        total = np.where(valid, stack, 0).sum(axis=0, dtype=np.int64)
+        out = np.round(total / np.maximum(count, 1))
+    else:
+        raise click.ClickException(f"Unknown aggregate {aggregate}")
+
+    return np.where(count > 0, out, snodas.NODATA).astype(DTYPE)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option(
+    "--input-file",
+    help="The SNODAS tar archive, or a .dat or .dat.gz snow depth file",
+    default="data/sources/snodas.tar",
+)
+@click.option("--cube-dir", help="The snow cube directory", default="data/cube")
+@click.option(
+    "--bbox",
+    help="The bounding box of the cube, only used when creating it",
+    default=None,
+)
+def append(input_file, cube_dir, bbox):
+    if not os.path.exists(os.path.join(cube_dir, "cube.json")):
+        data, transform, timestamp = snodas.read_snodas(input_file, bbox)
+        cube = SnowCube.create(
+            cube_dir, data.shape[1], data.shape[0], transform, snodas.CRS
+        )
+    else:
+        cube = SnowCube(cube_dir)
+        # crop the grid to the cube's window of it
+        col_off, row_off = ~snodas.TRANSFORM * (cube.transform.c, cube.transform.f)
+        window = Window(round(col_off), round(row_off), cube.width, cube.height)
+        data, transform, timestamp = snodas.read_snodas(input_file, window=window)
+        if not transform.almost_equals(cube.transform):
+            raise click.ClickException("The SNODAS grid doesn't line up with the cube")
+
+    date = f"{timestamp['year']}-{timestamp['month']}-{timestamp['day']}"
+    # days can't be replaced, so rerunning a day's download leaves it as it was
+    if date_key(date) in cube.dates():
+        print(f"SNOW CUBE: {date} is already in the cube, skipping")
+        return
+    print(f"SNOW CUBE: Appending {date}...")
+    cube.append(date, data)
+
+
+@cli.command()
+@click.option("--cube-dir", help="The snow cube directory", default="data/cube")
+@click.option("--date", help="The day to get, or the first day to aggregate")
+@click.option("--end-date", help="The last day to aggregate", default=None)
+@click.option(
+    "--aggregate",
+    type=click.Choice(["max", "mean"]),
+    default="max",
+    help="How to combine the days between --date and --end-date",
+)
+@click.option("--bbox", help="The bounding box to trim the output", default=None)
+@click.option(
+    "--output-file",
+    help="The output geotiff, in the same format as snodas.py's",
+    default="data/temp/snow-cube.tif",
+)
+def query(cube_dir, date, end_date, aggregate, bbox, output_file):
+    cube = SnowCube(cube_dir)
+    if bbox:
+        window = snodas.snap_window(bbox, cube.transform, cube.width, cube.height)
+        window_box = (
+            window.row_off,
+            window.col_off,
+            window.row_off + window.height,
+            window.col_off + window.width,
+        )
+        transform = rasterio.windows.transform(window, cube.transform)
+    else:
+        window_box = None
+        transform = cube.transform
+
+    data = cube.query(date, end_date, aggregate, window_box)
+    with rasterio.open(output_file, "w", **snodas.make_meta(data, transform)) as dst:
+        dst.write(data, 1)
+    print(f"SNOW CUBE: Wrote {output_file}")
+
+
+if __name__ == "__main__":
+    cli()
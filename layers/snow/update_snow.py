@@ -0,0 +1,536 @@
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import click
+import fiona
+import geopandas as gpd
+import mercantile
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+import sqlite3
+
+from rasterio.windows import Window
+from scipy import ndimage
+from shapely.geometry import box
+from tqdm import tqdm
+
+current_dir = os.path.dirname(__file__)
+sys.path.append(os.path.join(current_dir, "..", "..", "utils"))
+
+import pmtiles_archive
+
+# zoom levels of the snow tiles, matching tile_snow.sh
+MIN_ZOOM = 1
+MAX_ZOOM = 16
+# fraction of a tile's width around it that tippecanoe includes features from
+TILE_BUFFER = 5 / 256
+
+
+def polygonize(input_file, output_file):
+    subprocess.run(
+        [
+            "geopolygonize",
+            f"--input-file={input_file}",
+            f"--output-file={output_file}",
+            "--simplification-pixel-window=1",
+            "--min-blob-size=12",
+            "--smoothing-iterations=1",
+            "--label-name=depth",
+        ],
+        check=True,
+    )
+    polygons = gpd.read_file(output_file)
+    return polygons[polygons["depth"] != 0]
+
+
+def run_tippecanoe(polygons, output_file, min_zoom, max_zoom, temp_dir):
+    features_file = os.path.join(temp_dir, "snow-contours.geojsons")
+    polygons.to_file(features_file, driver="GeoJSONSeq")
+    subprocess.run(
+        [
+            "tippecanoe",
+            f"-Z{min_zoom}",
+            f"-z{max_zoom}",
+            "-P",
+            "--drop-densest-as-needed",
+            "-l",
+            "snow",
+            features_file,
+            "-o",
+            output_file,
+            "--force",
+        ],
+        check=True,
+    )
+
+
+class BlockGrid:
+    # the raster split into square blocks of pixels. polygons are stored clipped
+    # to the blocks, so the polygons of a block can be replaced on their own
+    def __init__(self, transform, width, height, block_size):
+        self.transform = transform
+        self.block_size = block_size
+        self.rows = math.ceil(height / block_size)
+        self.cols = math.ceil(width / block_size)
+        self.width = width
+        self.height = height
+
+    def window(self, row0, col0, row1, col1):
+        # the pixel window of a range of blocks, clipped to the raster
+        col_off = col0 * self.block_size
+        row_off = row0 * self.block_size
+        return Window(
+            col_off,
+            row_off,
+            min(col1 * self.block_size, self.width) - col_off,
+            min(row1 * self.block_size, self.height) - row_off,
+        )
+
+    def bounds(self, row, col):
+        window = self.window(row, col, row + 1, col + 1)
+        return rasterio.windows.bounds(window, self.transform)
+
+    def blocks_in(self, bounds):
+        min_x, min_y, max_x, max_y = bounds
+        (row0, row1), (col0, col1) = rasterio.transform.rowcol(
+            self.transform, [min_x, max_x], [max_y, min_y], op=math.floor
+        )
+        for row in range(
+            max(row0 // self.block_size, 0),
+            min(row1 // self.block_size, self.rows - 1) + 1,
+        ):
+            for col in range(
+                max(col0 // self.block_size, 0),
+                min(col1 // self.block_size, self.cols - 1) + 1,
+            ):
+                yield row, col
+
+    def changed(self, previous, current):
+        # which blocks have any pixel that changed
+        diff = previous != current
+        padded = np.zeros(
+            (self.rows * self.block_size, self.cols * self.block_size), dtype=bool
+        )
+        padded[: diff.shape[0], : diff.shape[1]] = diff
+        return padded.reshape(
+            self.rows, self.block_size, self.cols, self.block_size
+        ).any(axis=(1, 3))
+
+    def clip(self, polygons, blocks=None):
+        # clip the polygons to the blocks they overlap, keeping only the pieces
+        # in blocks if given
+        pieces = []
+        for depth, geometry in zip(polygons["depth"], polygons.geometry):
+            for row, col in self.blocks_in(geometry.bounds):
+                if blocks is not None and (row, col) not in blocks:
+                    continue
+                piece = geometry.intersection(box(*self.bounds(row, col)))
+                parts = [
+                    part
+                    for part in shapely.get_parts(piece)
+                    if part.geom_type == "Polygon" and part.area > 0
+                ]
+                if parts:
+                    pieces.append(
+                        {
+                            "depth": depth,
+                            "block_row": row,
+                            "block_col": col,
+                            "geometry": shapely.MultiPolygon(parts),
+                        }
+                    )
+        return gpd.GeoDataFrame(
+            pieces,
+            columns=["depth", "block_row", "block_col", "geometry"],
+            geometry="geometry",
+            crs=polygons.crs,
+        )
+
+
+def dissolve_blocks(polygons):
+    # join the pieces polygons were clipped into at block edges back together,
+    # so the tiles don't show the block grid
+    dissolved = polygons[["depth", "geometry"]].dissolve(by="depth", as_index=False)
+    return dissolved.explode(index_parts=False, ignore_index=True)
+
+
+def read_blocks(polygons_file, blocks):
+    # the pieces clipped to the blocks, found through the index on their block
+    # and keyed by their feature ids
+    by_row = {}
+    for row, col in blocks:
+        by_row.setdefault(row, []).append(col)
+    rows = sorted(by_row)
+    pieces = []
+    for i in range(0, len(rows), 100):
+        where = " OR ".join(
+            f"(block_row = {row} AND block_col IN ({', '.join(map(str, by_row[row]))}))"
+            for row in rows[i : i + 100]
+        )
+        pieces.append(
+            gpd.read_file(polygons_file, layer="snow", where=where, fid_as_index=True)
+        )
+    return pd.concat(pieces) if pieces else None
+
+
+def read_features(polygons_file, areas):
+    # the dissolved features over any of the areas, found through the spatial
+    # index and keyed by their feature ids
+    areas = np.asarray(areas, dtype=object)
+    features = gpd.read_file(
+        polygons_file,
+        layer="features",
+        mask=shapely.union_all(shapely.envelope(areas)),
+        fid_as_index=True,
+    )
+    # features that only touch an area aren't over it
+    found, indices = features.sindex.query(areas, predicate="intersects")
+    overlap = shapely.relate_pattern(
+        features.geometry.values[indices], areas[found], "T********"
+    )
+    return features.iloc[np.unique(indices[overlap])]
+
+
+def connected_pieces(polygons_file, grid, seeds):
+    # every piece reachable from the seeds through pieces of the same depth
+    # that touch, which are the pieces dissolve_blocks would join them with.
+    # pieces are clipped to their block, so they only touch pieces in the same
+    # or a neighbouring block, and only those blocks are read
+    loaded = {}
+    members = seeds[~seeds.index.duplicated()]
+    frontier = members
+    while len(frontier) > 0:
+        blocks = {
+            (r, c)
+            for row, col in zip(frontier["block_row"], frontier["block_col"])
+            for r in range(max(row - 1, 0), min(row + 2, grid.rows))
+            for c in range(max(col - 1, 0), min(col + 2, grid.cols))
+        }
+        unread = blocks - loaded.keys()
+        if unread:
+            pieces = read_blocks(polygons_file, unread)
+            for block in unread:
+                loaded[block] = pieces.iloc[:0]
+            for block, group in pieces.groupby(["block_row", "block_col"]):
+                loaded[block] = group
+        candidates = pd.concat([loaded[block] for block in blocks])
+        candidates = candidates[~candidates.index.isin(members.index)]
+        if len(candidates) == 0:
+            break
+
+        found, indices = frontier.sindex.query(
+            candidates.geometry, predicate="intersects"
+        )
+        same_depth = (
+            candidates["depth"].to_numpy()[found]
+            == frontier["depth"].to_numpy()[indices]
+        )
+        frontier = candidates.iloc[np.unique(found[same_depth])]
+        members = pd.concat([members, frontier])
+    return members
+
+
+def delete_rows(polygons_file, layer, condition, keys):
+    # rows are deleted straight from the geopackage. the spatial index's delete
+    # trigger is plain SQL, so it's kept up to date
+    connection = sqlite3.connect(polygons_file)
+    connection.executemany(
+        f'DELETE FROM "{layer}" WHERE {condition};', [tuple(key) for key in keys]
+    )
+    connection.commit()
+    connection.close()
+
+
+def append_rows(polygons_file, layer, rows):
+    # rows are added through GDAL, which updates the spatial index
+    if len(rows) > 0:
+        rows.to_file(polygons_file, driver="GPKG", layer=layer, mode="a")
+
+
+def affected_tiles(grid, blocks, zoom):
+    # the tiles whose buffer reaches into any of the blocks
+    buffer = 360 / 2**zoom * TILE_BUFFER
+    tiles = set()
+    for row, col in blocks:
+        west, south, east, north = grid.bounds(row, col)
+        tiles.update(
+            mercantile.tiles(
+                max(west - buffer, -180),
+                max(south - buffer, -85.051129),
+                min(east + buffer, 180),
+                min(north + buffer, 85.051129),
+                zoom,
+            )
+        )
+    return sorted(tiles)
+
+
+def retile(polygons, tiles, zoom, temp_dir):
+    # rebuild the tiles at one zoom from the features around them. returns
+    # tile id -> contents, with None for tiles that are now empty
+    boxes = []
+    for tile in tiles:
+        west, south, east, north = mercantile.bounds(tile)
+        buffer = (east - west) * TILE_BUFFER
+        boxes.append(box(west - buffer, south - buffer, east + buffer, north + buffer))
+    _, indices = polygons.sindex.query(boxes, predicate="intersects")
+    subset = polygons.iloc[np.unique(indices)]
+
+    contents = {
+        pmtiles_archive.zxy_to_tileid(tile.z, tile.x, tile.y): None for tile in tiles
+    }
+    if len(subset) == 0:
+        return contents
+
+    subset_file = os.path.join(temp_dir, f"snow-{zoom}.pmtiles")
+    run_tippecanoe(subset, subset_file, zoom, zoom, temp_dir)
+    reader = pmtiles_archive.PMTilesReader(subset_file)
+    for tile in tiles:
+        contents[pmtiles_archive.zxy_to_tileid(tile.z, tile.x, tile.y)] = (
+            reader.get_tile(tile.z, tile.x, tile.y)
+        )
+    reader.close()
+    return contents
+
+
+def full_build(input_file, grid, polygons_file, output_file, temp_dir):
+    print("SNOW UPDATE: Polygonizing the whole raster...")
+    polygons = polygonize(input_file, os.path.join(temp_dir, "snow-contours.gpkg"))
+    # the block clipped copy and the whole polygons are kept for the next
+    # incremental update, the tiles get the whole polygons
+    if os.path.exists(polygons_file):
+        os.unlink(polygons_file)
+    grid.clip(polygons).to_file(polygons_file, driver="GPKG", layer="snow")
+    polygons[["depth", "geometry"]].explode(index_parts=False).to_file(
+        polygons_file, driver="GPKG", layer="features"
+    )
+    # the pieces of a block are looked up and replaced by its row and column
+    connection = sqlite3.connect(polygons_file)
+    connection.execute('CREATE INDEX "snow_block" ON "snow" (block_row, block_col);')
+    connection.commit()
+    connection.close()
+
+    print("SNOW UPDATE: Tiling...")
+    run_tippecanoe(polygons, output_file, MIN_ZOOM, MAX_ZOOM, temp_dir)
+    return {"full": True, "changed_blocks": grid.rows * grid.cols, "changed_tiles": []}
+
+
+def incremental_build(
+    input_file, grid, changed, margin, polygons_file, output_file, temp_dir
+):
+    # re-polygonize each group of changed blocks with a margin of unchanged
+    # blocks around it, so the polygons near its edges are shaped the same way
+    # a polygonization of the whole raster would shape them
+    labels, count = ndimage.label(
+        (
+            ndimage.binary_dilation(
+                changed, structure=np.ones((3, 3)), iterations=margin
+            )
+            if margin
+            else changed
+        ),
+        structure=np.ones((3, 3)),
+    )
+    changed_blocks = {(int(row), int(col)) for row, col in zip(*np.nonzero(changed))}
+
+    print(f"SNOW UPDATE: Polygonizing {count} changed regions...")
+    new_polygons = []
+    with rasterio.open(input_file) as src:
+        for i, (rows, cols) in enumerate(tqdm(ndimage.find_objects(labels))):
+            window = grid.window(rows.start, cols.start, rows.stop, cols.stop)
+            region_file = os.path.join(temp_dir, f"region-{i}.tif")
+            meta = src.meta.copy()
+            meta.update(
+                width=window.width,
+                height=window.height,
+                transform=rasterio.windows.transform(window, src.transform),
+            )
+            with rasterio.open(region_file, "w", **meta) as dst:
+                dst.write(src.read(1, window=window), 1)
+
+            region = polygonize(region_file, os.path.join(temp_dir, f"region-{i}.gpkg"))
+            # only keep the polygons in the changed blocks, not the margin
+            region_blocks = {
+                (row, col) for row, col in changed_blocks if labels[row, col] == i + 1
+            }
+            new_polygons.append(grid.clip(region, region_blocks))
+
+    # swap the changed blocks' pieces for the new ones in place
+    delete_rows(
+        polygons_file, "snow", "block_row = ? AND block_col = ?", changed_blocks
+    )
+    append_rows(polygons_file, "snow", pd.concat(new_polygons, ignore_index=True))
+
+    # only the features over the changed blocks, or joined to the pieces in
+    # them, are dissolved again. the rest of each of those features' pieces
+    # are found by following the pieces it touches from block to block
+    print("SNOW UPDATE: Dissolving changed features...")
+    changed_areas = [box(*grid.bounds(row, col)) for row, col in changed_blocks]
+    old_features = read_features(polygons_file, changed_areas)
+    seeds = read_blocks(polygons_file, changed_blocks)
+    if len(old_features) > 0:
+        nearby = read_blocks(
+            polygons_file,
+            {
+                block
+                for bounds in old_features.geometry.bounds.itertuples(index=False)
+                for block in grid.blocks_in(bounds)
+            },
+        )
+        found, indices = old_features.sindex.query(
+            nearby.geometry, predicate="intersects"
+        )
+        overlap = shapely.relate_pattern(
+            nearby.geometry.values[found],
+            old_features.geometry.values[indices],
+            "T********",
+        ) & (
+            nearby["depth"].to_numpy()[found]
+            == old_features["depth"].to_numpy()[indices]
+        )
+        seeds = pd.concat([seeds, nearby.iloc[np.unique(found[overlap])]])
+    pieces = connected_pieces(polygons_file, grid, seeds)
+    features = dissolve_blocks(pieces)
+
+    # the old features over the pieces, which now are part of the new ones
+    if len(pieces) > 0:
+        old_features = pd.concat(
+            [old_features, read_features(polygons_file, pieces.geometry.values)]
+        )
+    delete_rows(
+        polygons_file,
+        "features",
+        "fid = ?",
+        [(int(fid),) for fid in np.unique(old_features.index)],
+    )
+    append_rows(polygons_file, "features", features)
+
+    print("SNOW UPDATE: Retiling changed tiles...")
+    tiles = {}
+    for zoom in tqdm(range(MIN_ZOOM, MAX_ZOOM + 1)):
+        zoom_tiles = affected_tiles(grid, changed_blocks, zoom)
+        # only the features in the tiles and their buffers are read
+        buffer = 360 / 2**zoom * TILE_BUFFER
+        areas = [
+            box(*mercantile.bounds(tile)).buffer(buffer, join_style="mitre")
+            for tile in zoom_tiles
+        ]
+        nearby = gpd.read_file(
+            polygons_file, layer="features", mask=shapely.union_all(areas)
+        )
+        tiles.update(retile(nearby, zoom_tiles, zoom, temp_dir))
+
+    patched_file = os.path.join(temp_dir, "snow-patched.pmtiles")
+    changed_tiles = pmtiles_archive.patch_archive(output_file, patched_file, tiles)
+    shutil.move(patched_file, output_file)
+
+    return {
+        "full": False,
+        "changed_blocks": len(changed_blocks),
+        "changed_tiles": [
+            "{}/{}/{}".format(*pmtiles_archive.tileid_to_zxy(tile_id))
+            for tile_id in changed_tiles
+        ],
+    }
+
+
+@click.command()
+@click.option(
+    "--input-file",
+    help="Today's quantized snow raster",
+    default="data/temp/snow-quantized.tif",
+)
+@click.option(
+    "--state-dir",
+    help="Where the previous run's quantized raster and polygons are kept",
+    default="data/state",
+)
+@click.option(
+    "--output-file",
+    help="The snow pmtiles archive to update",
+    default="data/output/snow.pmtiles",
+)
+@click.option(
+    "--manifest-file",
+    help="Where to list the tiles that changed",
+    default="data/output/snow-changes.json",
+)
+@click.option(
+    "--block-size",
+    help="Width and height in pixels of the blocks the rasters are compared in",
+    default=64,
+)
+@click.option(
+    "--margin",
+    help="Unchanged blocks around changed ones to re-polygonize for context",
+    default=1,
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    default=False,
+    help="Rebuild everything instead of only what changed",
+)
+def cli(input_file, state_dir, output_file, manifest_file, block_size, margin, full):
+    os.makedirs(state_dir, exist_ok=True)
+    previous_file = os.path.join(state_dir, "snow-quantized.tif")
+    polygons_file = os.path.join(state_dir, "snow-polygons.gpkg")
+
+    with rasterio.open(input_file) as src:
+        grid = BlockGrid(src.transform, src.width, src.height, block_size)
+        profile = (src.transform, src.width, src.height, src.crs)
+
+    # the previous run can only be patched if it covers the same grid
+    previous = None
+    if (
+        not full
+        and os.path.exists(previous_file)
+        and os.path.exists(polygons_file)
+        and os.path.exists(output_file)
+        and "features" in fiona.listlayers(polygons_file)
+    ):
+        with rasterio.open(previous_file) as src:
+            if (src.transform, src.width, src.height, src.crs) == profile:
+                previous = src.read(1)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if previous is None:
+            manifest = full_build(
+                input_file, grid, polygons_file, output_file, temp_dir
+            )
+        else:
+            with rasterio.open(input_file) as src:
+                changed = grid.changed(previous, src.read(1))
+            print(f"SNOW UPDATE: {changed.sum()} of {changed.size} blocks changed")
+            if changed.any():
+                manifest = incremental_build(
+                    input_file,
+                    grid,
+                    changed,
+                    margin,
+                    polygons_file,
+                    output_file,
+                    temp_dir,
+                )
+            else:
+                manifest = {"full": False, "changed_blocks": 0, "changed_tiles": []}
+
+    shutil.copyfile(input_file, previous_file)
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f)
+    print(
+        f"SNOW UPDATE: Done, {len(manifest['changed_tiles'])} tiles changed"
+        if not manifest["full"]
+        else f"SNOW UPDATE: Done, rebuilt {output_file}"
+    )
+
+
+if __name__ == "__main__":
+    cli()
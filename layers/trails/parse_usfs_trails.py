@@ -7,8 +7,8 @@ import os
 @click.option(
     "--input-file",
     type=click.Path(file_okay=True, dir_okay=True),
-    help="The input .gdb file",
-    default="data/sources/S_USA.TrailNFS_Publish.gdb",
+    help="The input trails, ideally ingested into a spatially indexed geopackage",
+    default="data/sources/usfs_trails.gpkg",
 )
 @click.option(
     "--output-file",
@@ -30,7 +30,8 @@ def cli(input_file, output_file, bbox):
 
     # read the input file
     with fiona.open(input_file, layer="TrailNFS_Publish") as src:
-        bbox = tuple(float(x) for x in bbox.split(","))
+        x1, y1, x2, y2 = [float(x) for x in bbox.split(",")]
+        bbox = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
         filtered = src.filter(bbox=bbox)
 
         snow_trails = []
@@ -18,18 +18,18 @@ from utils import clean_attributes
 )
 @click.option(
     "--usfs-input-file",
-    help="The USFS wildfire perimeter shapefile",
-    default="data/sources/USFSPerimeters/*.shp",
+    help="The USFS wildfire perimeters, ideally ingested into a spatially indexed geopackage",
+    default="data/sources/usfs_perimeters.gpkg",
 )
 @click.option(
     "--blm-input-file",
-    help="The BLM wildfire perimeter shapefile",
-    default="data/sources/BLMPerimeters/*.shp",
+    help="The BLM wildfire perimeters, ideally ingested into a spatially indexed geopackage",
+    default="data/sources/blm_perimeters.gpkg",
 )
 @click.option(
     "--nifc-input-file",
-    help="The NIFC wildfire perimeter shapefile",
-    default="data/sources/NIFCPerimeters/*.shp",
+    help="The NIFC wildfire perimeters, ideally ingested into a spatially indexed geopackage",
+    default="data/sources/nifc_perimeters.gpkg",
 )
 @click.option(
     "--output-file",
@@ -42,7 +42,8 @@ def cli(bbox, usfs_input_file, blm_input_file, nifc_input_file, output_file):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    xmin, ymin, xmax, ymax = [float(x) for x in bbox.split(",")]
+    x1, y1, x2, y2 = [float(x) for x in bbox.split(",")]
+    xmin, ymin, xmax, ymax = min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
     bounding_box = box(xmin, ymin, xmax, ymax)
 
     usfs_file = None
@@ -52,22 +53,22 @@ def cli(bbox, usfs_input_file, blm_input_file, nifc_input_file, output_file):
     # Load fire datasets
     print("Loading fire datasets...")
     if len(glob.glob(usfs_input_file)) == 0:
-        print("No USFS shapefile found at path {}".format(usfs_input_file))
+        print("No USFS perimeters found at path {}".format(usfs_input_file))
     else:
         usfs_file = glob.glob(usfs_input_file)[0]
 
     if len(glob.glob(blm_input_file)) == 0:
-        print("No BLM shapefile found at path {}".format(blm_input_file))
+        print("No BLM perimeters found at path {}".format(blm_input_file))
     else:
         blm_file = glob.glob(blm_input_file)[0]
 
     if len(glob.glob(nifc_input_file)) == 0:
-        print("No NIFC shapefile found at path {}".format(nifc_input_file))
+        print("No NIFC perimeters found at path {}".format(nifc_input_file))
     else:
         nifc_file = glob.glob(nifc_input_file)[0]
 
     if usfs_file == None and blm_file == None and nifc_file == None:
-        raise Exception("No shapefiles provided")
+        raise Exception("No perimeters provided")
 
     def process_usfs_feature(feature):
         # check if the bounding box intersects the geometry
@@ -105,7 +106,8 @@ def cli(bbox, usfs_input_file, blm_input_file, nifc_input_file, output_file):
 
     if usfs_file != None:
         with fiona.open(usfs_file, "r") as shapefile:
-            for feature in tqdm(shapefile):
+            # only read the perimeters near the bbox
+            for feature in tqdm(shapefile.filter(bbox=(xmin, ymin, xmax, ymax))):
                 res = process_usfs_feature(feature)
                 if res != None:
                     cleaned_usfs_features.append(res)
@@ -144,7 +146,8 @@ def cli(bbox, usfs_input_file, blm_input_file, nifc_input_file, output_file):
 
     if blm_file != None:
         with fiona.open(blm_file, "r") as shapefile:
-            for feature in tqdm(shapefile):
+            # only read the perimeters near the bbox
+            for feature in tqdm(shapefile.filter(bbox=(xmin, ymin, xmax, ymax))):
                 res = process_blm_feature(feature)
                 if res != None:
                     cleaned_blm_features.append(res)
@@ -187,7 +190,8 @@ def cli(bbox, usfs_input_file, blm_input_file, nifc_input_file, output_file):
 
     if nifc_file != None:
         with fiona.open(nifc_file, "r") as shapefile:
-            for feature in tqdm(shapefile):
+            # only read the perimeters near the bbox
+            for feature in tqdm(shapefile.filter(bbox=(xmin, ymin, xmax, ymax))):
                 res = process_nifc_feature(feature)
                 if res != None:
                     cleaned_nifc_features.append(res)
@@ -0,0 +1,79 @@
+import click
+import os
+
+import fiona
+
+from tqdm import tqdm
+
+
+@click.command()
+@click.option(
+    "--input-file",
+    type=click.Path(file_okay=True, dir_okay=True),
+    help="The source dataset, e.g. a shapefile or .gdb",
+    required=True,
+)
+@click.option(
+    "--output-file",
+    help="The output geopackage",
+    required=True,
+)
+@click.option(
+    "--layer",
+    help="The layer of the source to ingest, if it has several",
+    default=None,
+)
+@click.option(
+    "--layer-name",
+    help="The name of the output layer, defaults to the source layer's name",
+    default=None,
+)
+@click.option(
+    "--fields",
+    help="A comma separated list of the fields to keep, defaults to all of them",
+    default=None,
+)
+def cli(input_file, output_file, layer, layer_name, fields):
+    # make the path to the output directory if it doesn't exist
+    output_dir = os.path.dirname(output_file)
+    if output_dir != "" and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    with fiona.open(input_file, layer=layer) as src:
+        properties = src.schema["properties"]
+        if fields:
+            missing = [f for f in fields.split(",") if f not in properties]
+            if missing:
+                raise click.ClickException(
+                    f"{input_file} has no field(s) {', '.join(missing)}"
+                )
+            properties = {f: properties[f] for f in fields.split(",")}
+
+        # shapefiles declare a single geometry type but can mix in multi-part
+        # geometries, so don't restrict it
+        schema = {"geometry": "Unknown", "properties": properties}
+
+        print(f"Ingesting {len(src)} features from {input_file}...")
+        # geopackages get an r-tree spatial index, so later bbox filters on the
+        # output only read the features near the bbox
+        with fiona.open(
+            output_file,
+            "w",
+            driver="GPKG",
+            crs=src.crs,
+            schema=schema,
+            layer=layer_name or src.name,
+            SPATIAL_INDEX="YES",
+        ) as dst:
+            dst.writerecords(
+                {
+                    "geometry": feature["geometry"],
+                    "properties": {f: feature["properties"][f] for f in properties},
+                }
+                for feature in tqdm(src)
+                if feature["geometry"] is not None
+            )
+
+
+if __name__ == "__main__":
+    cli()
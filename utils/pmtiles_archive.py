@@ -0,0 +1,415 @@
+import bisect
+import gzip
+import hashlib
+import json
+import os
+import struct
+
+# see https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+HEADER_SIZE = 127
+# the header and root directory must fit in the first 16 KiB of the archive
+ROOT_SIZE = 16384
+
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+
+TILE_TYPE_MVT = 1
+TILE_TYPE_PNG = 2
+TILE_TYPE_JPEG = 3
+TILE_TYPE_WEBP = 4
+
+HEADER_FORMAT = "<7sB11Q6B4iB2i"
+
+
+def rotate(n, x, y, rx, ry):
+    if ry == 0:
+        if rx == 1:
+            x = n - 1 - x
+            y = n - 1 - y
+        x, y = y, x
+    return x, y
+
+
+def zxy_to_tileid(z, x, y):
+    # tile ids number every tile of every zoom level along a hilbert curve
+    acc = ((1 << (z * 2)) - 1) // 3
+    s = 1 << (z - 1) if z > 0 else 0
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        acc += s * s * ((3 * rx) ^ ry)
+        x, y = rotate(s, x, y, rx, ry)
+        s >>= 1
+    return acc
+
+
+def tileid_to_zxy(tile_id):
+    # find the zoom level the id falls in, then walk down the hilbert curve
+    z = 0
+    acc = 0
+    while acc + (1 << (z * 2)) <= tile_id:
+        acc += 1 << (z * 2)
+        z += 1
+
+    n = 1 << z
+    t = tile_id - acc
+    x = y = 0
+    s = 1
+    while s < n:
+        rx = 1 & (t // 2)
+        ry = 1 & (t ^ rx)
+        x, y = rotate(s, x, y, rx, ry)
+        x += s * rx
+        y += s * ry
+        t //= 4
+        s *= 2
+    return z, x, y
+
+
+def write_varint(buf, value):
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def serialize_directory(entries):
+    # entries are (tile_id, offset, length, run_length) sorted by tile id
+    buf = bytearray()
+    write_varint(buf, len(entries))
+
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        write_varint(buf, tile_id - last_id)
+        last_id = tile_id
+    for _, _, _, run_length in entries:
+        write_varint(buf, run_length)
+    for _, _, length, _ in entries:
+        write_varint(buf, length)
+
+    previous = None
+    for entry in entries:
+        _, offset, length, _ = entry
+        # an offset of 0 means the tile directly follows the previous one
+        if previous is not None and offset == previous[1] + previous[2]:
+            write_varint(buf, 0)
+        else:
+            write_varint(buf, offset + 1)
+        previous = entry
+
+    return gzip.compress(bytes(buf))
+
+
+def read_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def deserialize_directory(data):
+    # the inverse of serialize_directory, for an uncompressed directory
+    count, pos = read_varint(data, 0)
+
+    tile_ids = []
+    last_id = 0
+    for _ in range(count):
+        delta, pos = read_varint(data, pos)
+        last_id += delta
+        tile_ids.append(last_id)
+    run_lengths = []
+    for _ in range(count):
+        run_length, pos = read_varint(data, pos)
+        run_lengths.append(run_length)
+    lengths = []
+    for _ in range(count):
+        length, pos = read_varint(data, pos)
+        lengths.append(length)
+
+    entries = []
+    for i in range(count):
+        offset, pos = read_varint(data, pos)
+        if offset == 0 and i > 0:
+            offset = entries[-1][1] + entries[-1][2]
+        else:
+            offset -= 1
+        entries.append((tile_ids[i], offset, lengths[i], run_lengths[i]))
+    return entries
+
+
+def run_length_encode(entries):
+    # merge runs of consecutive tile ids that point at the same tile data
+    merged = []
+    for tile_id, offset, length, run_length in entries:
+        if merged:
+            last_id, last_offset, last_length, last_run = merged[-1]
+            if (
+                tile_id == last_id + last_run
+                and offset == last_offset
+                and length == last_length
+            ):
+                merged[-1] = (last_id, last_offset, last_length, last_run + 1)
+                continue
+        merged.append((tile_id, offset, length, run_length))
+    return merged
+
+
+def build_directories(entries):
+    # put every entry in the root directory if it fits, otherwise split the
+    # entries into leaf directories addressed from the root
+    root = serialize_directory(entries)
+    if len(root) <= ROOT_SIZE - HEADER_SIZE:
+        return root, b""
+
+    leaf_size = 4096
+    while True:
+        root_entries = []
+        leaves = bytearray()
+        for i in range(0, len(entries), leaf_size):
+            leaf = serialize_directory(entries[i : i + leaf_size])
+            root_entries.append((entries[i][0], len(leaves), len(leaf), 0))
+            leaves += leaf
+
+        root = serialize_directory(root_entries)
+        if len(root) <= ROOT_SIZE - HEADER_SIZE:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+class PMTilesWriter:
+    # Writes a PMTiles v3 archive in a single pass. The header and root directory
+    # are written into space reserved at the start of the file once every tile is
+    # known, the metadata follows them and the tile data is streamed after the
+    # metadata. Leaf directories, when needed, are appended after the tile data.
+    # Tiles with identical contents are only stored once.
+    def __init__(
+        self,
+        output_file,
+        metadata,
+        tile_type=TILE_TYPE_WEBP,
+        tile_compression=COMPRESSION_NONE,
+    ):
+        if os.path.exists(output_file):
+            os.unlink(output_file)
+
+        self.file = open(output_file, "wb")
+        self.tile_type = tile_type
+        self.tile_compression = tile_compression
+        self.entries = []
+        self.clustered = True
+        self.last_tile_id = -1
+        # hash of each tile's contents -> (offset, length) of the stored copy
+        self.contents = {}
+        self.deduplicated_tiles = 0
+        self.deduplicated_bytes = 0
+
+        self.file.write(b"\x00" * ROOT_SIZE)
+        self.metadata_offset = ROOT_SIZE
+        self.metadata = gzip.compress(json.dumps(metadata).encode())
+        self.file.write(self.metadata)
+
+        self.tile_data_offset = self.metadata_offset + len(self.metadata)
+        self.tile_data_length = 0
+
+    def write_tile(self, tile_id, data):
+        if tile_id <= self.last_tile_id:
+            # tiles written out of order can still be addressed, but the
+            # archive isn't clustered anymore
+            self.clustered = False
+        self.last_tile_id = max(tile_id, self.last_tile_id)
+
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if digest in self.contents:
+            offset, length = self.contents[digest]
+            self.entries.append((tile_id, offset, length, 1))
+            self.deduplicated_tiles += 1
+            self.deduplicated_bytes += length
+            return
+
+        self.contents[digest] = (self.tile_data_length, len(data))
+        self.entries.append((tile_id, self.tile_data_length, len(data), 1))
+        self.file.write(data)
+        self.tile_data_length += len(data)
+
+    def finalize(self, bounds, min_zoom, max_zoom, center_zoom=None):
+        self.entries.sort(key=lambda entry: entry[0])
+        entries = run_length_encode(self.entries)
+        root, leaves = build_directories(entries)
+
+        leaf_offset = self.tile_data_offset + self.tile_data_length
+        self.file.write(leaves)
+
+        min_lon, min_lat, max_lon, max_lat = bounds
+        if center_zoom is None:
+            center_zoom = min_zoom
+
+        header = struct.pack(
+            HEADER_FORMAT,
+            b"PMTiles",
+            3,
+            HEADER_SIZE,
+            len(root),
+            self.metadata_offset,
+            len(self.metadata),
+            leaf_offset,
+            len(leaves),
+            self.tile_data_offset,
+            self.tile_data_length,
+            len(self.entries),
+            len(entries),
+            len(self.contents),
+            1 if self.clustered else 0,
+            COMPRESSION_GZIP,
+            self.tile_compression,
+            self.tile_type,
+            min_zoom,
+            max_zoom,
+            int(min_lon * 10_000_000),
+            int(min_lat * 10_000_000),
+            int(max_lon * 10_000_000),
+            int(max_lat * 10_000_000),
+            center_zoom,
+            int((min_lon + max_lon) / 2 * 10_000_000),
+            int((min_lat + max_lat) / 2 * 10_000_000),
+        )
+
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.write(root)
+        self.file.close()
+
+
+class PMTilesReader:
+    # Reads tiles from a PMTiles v3 archive. Leaf directories are read as they
+    # are needed and the most recently used ones are kept in memory.
+    MAX_CACHED_LEAVES = 64
+
+    def __init__(self, input_file):
+        self.file = open(input_file, "rb")
+        fields = struct.unpack(HEADER_FORMAT, self.file.read(HEADER_SIZE))
+        if fields[0] != b"PMTiles" or fields[1] != 3:
+            raise ValueError(f"{input_file} is not a PMTiles v3 archive")
+
+        (
+            root_offset,
+            root_length,
+            self.metadata_offset,
+            self.metadata_length,
+            self.leaf_offset,
+            _,
+            self.tile_data_offset,
+        ) = fields[2:9]
+        self.internal_compression = fields[14]
+        self.tile_compression = fields[15]
+        self.tile_type = fields[16]
+        self.min_zoom = fields[17]
+        self.max_zoom = fields[18]
+        self.bounds = tuple(value / 10_000_000 for value in fields[19:23])
+        self.center_zoom = fields[23]
+
+        self.root = self._read_directory(root_offset, root_length)
+        self.leaves = {}
+
+    def _read(self, offset, length):
+        self.file.seek(offset)
+        data = self.file.read(length)
+        if self.internal_compression == COMPRESSION_GZIP:
+            data = gzip.decompress(data)
+        return data
+
+    def _read_directory(self, offset, length):
+        return deserialize_directory(self._read(offset, length))
+
+    def _leaf(self, offset, length):
+        key = (offset, length)
+        if key in self.leaves:
+            self.leaves[key] = self.leaves.pop(key)
+        else:
+            if len(self.leaves) >= self.MAX_CACHED_LEAVES:
+                del self.leaves[next(iter(self.leaves))]
+            self.leaves[key] = self._read_directory(self.leaf_offset + offset, length)
+        return self.leaves[key]
+
+    def metadata(self):
+        return json.loads(self._read(self.metadata_offset, self.metadata_length))
+
+    def get_tile(self, z, x, y):
+        # returns the tile's data as stored, or None if it isn't in the archive
+        return self.get_tile_by_id(zxy_to_tileid(z, x, y))
+
+    def get_tile_by_id(self, tile_id):
+        entries = self.root
+        while True:
+            i = bisect.bisect_right(entries, (tile_id, float("inf"))) - 1
+            if i < 0:
+                return None
+            entry_id, offset, length, run_length = entries[i]
+            if run_length == 0:
+                entries = self._leaf(offset, length)
+                continue
+            if tile_id >= entry_id + run_length:
+                return None
+            self.file.seek(self.tile_data_offset + offset)
+            return self.file.read(length)
+
+    def tile_ids(self):
+        # every tile id in the archive, in order
+        def walk(entries):
+            for entry_id, offset, length, run_length in entries:
+                if run_length == 0:
+                    yield from walk(
+                        self._read_directory(self.leaf_offset + offset, length)
+                    )
+                else:
+                    yield from range(entry_id, entry_id + run_length)
+
+        yield from walk(self.root)
+
+    def close(self):
+        self.file.close()
+
+
+def patch_archive(input_file, output_file, tiles):
+    # copy an archive to output_file, replacing the tiles in the tiles dict of
+    # tile id -> contents, or removing them where the contents are None. returns
+    # the ids of the tiles whose contents changed
+    reader = PMTilesReader(input_file)
+    writer = PMTilesWriter(
+        output_file,
+        reader.metadata(),
+        tile_type=reader.tile_type,
+        tile_compression=reader.tile_compression,
+    )
+
+    changed = []
+    patched = sorted(tiles)
+    i = 0
+
+    def write_patched(tile_id, old):
+        new = tiles[tile_id]
+        if new != old:
+            changed.append(tile_id)
+        if new is not None:
+            writer.write_tile(tile_id, new)
+
+    # both the archive and the patches are in tile id order, so merge them
+    for tile_id in reader.tile_ids():
+        while i < len(patched) and patched[i] < tile_id:
+            write_patched(patched[i], None)
+            i += 1
+        if i < len(patched) and patched[i] == tile_id:
+            write_patched(tile_id, reader.get_tile_by_id(tile_id))
+            i += 1
+        else:
+            writer.write_tile(tile_id, reader.get_tile_by_id(tile_id))
+    for tile_id in patched[i:]:
+        write_patched(tile_id, None)
+
+    writer.finalize(reader.bounds, reader.min_zoom, reader.max_zoom, reader.center_zoom)
+    reader.close()
+    return changed
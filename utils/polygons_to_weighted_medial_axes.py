@@ -1,15 +1,28 @@
 import click
+import hashlib
 import os
 import multiprocessing
+import sqlite3
 
 import networkx as nx
+import numpy as np
 import geojson
 
+import shapely
 import skgeom as sg
 from shapely.geometry import Polygon, LineString, Point
+from shapely.ops import polylabel
 
 from tqdm import tqdm
 
+# tolerance the polygons are simplified with before their skeletons are made
+SKELETON_SIMPLIFY_TOLERANCE = 0.5
+# polygons must fill at least this much of their convex hull to get a principal
+# axis instead of a medial axis, so curved or branching shapes still get one
+FAST_MIN_SOLIDITY = 0.8
+# bump when the medial axes change, so cached ones aren't reused
+CACHE_VERSION = 1
+
 
 def load_geojson_geometries(input_file):
     with open(input_file) as f:
@@ -66,6 +79,150 @@ def get_heaviest_path(graph, node_weights, node, visited):
     return get_heaviest_path(graph, node_weights, max_weight_node, visited) + [node]
 
 
+def build_adjacency(edges):
+    # index the nodes of the edges in the order they're first seen, with each
+    # node's neighbors in the order they were added, the same orders as in a
+    # networkx graph built from the edges
+    indices = {}
+    neighbors = []
+    for a, b in edges:
+        for node in (a, b):
+            if node not in indices:
+                indices[node] = len(indices)
+                neighbors.append({})
+        i, j = indices[a], indices[b]
+        neighbors[i][j] = None
+        neighbors[j][i] = None
+    return list(indices), [list(n) for n in neighbors]
+
+
+def is_tree(adjacency):
+    if len(adjacency) == 0:
+        return False
+    edge_count = sum(len(n) for n in adjacency)
+    if edge_count != 2 * (len(adjacency) - 1):
+        return False
+    order, _ = bfs(adjacency, 0)
+    return len(order) == len(adjacency)
+
+
+def bfs(adjacency, start):
+    # returns the nodes in breadth first order from start, and each one's parent
+    parents = [-1] * len(adjacency)
+    parents[start] = start
+    order = [start]
+    for node in order:
+        for n in adjacency[node]:
+            if parents[n] == -1:
+                parents[n] = node
+                order.append(n)
+    return order, parents
+
+
+def tree_center(adjacency):
+    # the center of a tree is the middle of its longest path, found from the
+    # node furthest from any node and the node furthest from that one. with two
+    # middle nodes, take the first, as nx.center does
+    order, _ = bfs(adjacency, 0)
+    order, parents = bfs(adjacency, order[-1])
+    path = [order[-1]]
+    while parents[path[-1]] != path[-1]:
+        path.append(parents[path[-1]])
+    length = len(path) - 1
+    return min(path[length // 2], path[(length + 1) // 2])
+
+
+def subtree_weights(adjacency, coords, center):
+    # the weight of each node is the length of the edges of its subtree when the
+    # tree hangs from center, summed children first, in neighbor order, the
+    # same way as dfs_sum_weights
+    order, parents = bfs(adjacency, center)
+    children = np.array(order[1:])
+    parent_nodes = np.array([parents[n] for n in children], dtype=int)
+    delta = coords[children] - coords[parent_nodes]
+    lengths = np.zeros(len(adjacency))
+    lengths[children] = np.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1])
+    lengths = lengths.tolist()
+
+    weights = [0.0] * len(adjacency)
+    for node in reversed(order):
+        total = 0
+        for n in adjacency[node]:
+            if n != parents[node]:
+                total += weights[n] + lengths[n]
+        weights[node] = total
+    return weights
+
+
+def tree_heaviest_path(adjacency, weights, node, parent):
+    # follow the heaviest child down from node, stopping before the leaves, and
+    # return the path bottom up like get_heaviest_path
+    path = [node]
+    while True:
+        max_weight = 0
+        max_weight_node = None
+        for n in adjacency[node]:
+            if n != parent and weights[n] > max_weight:
+                max_weight = weights[n]
+                max_weight_node = n
+        if max_weight_node is None:
+            return path[::-1]
+        parent, node = node, max_weight_node
+        path.append(node)
+
+
+def tree_medial_axis(nodes, adjacency):
+    # linear time version of graph_medial_axis for skeletons that are trees
+    coords = np.array(nodes, dtype=float)
+    center = tree_center(adjacency)
+    weights = subtree_weights(adjacency, coords, center)
+
+    # get the two neighbors with the highest weights
+    neighbor_weights = [(n, weights[n]) for n in adjacency[center]]
+    neighbor_weights.sort(key=lambda x: x[1], reverse=True)
+
+    # get the two heaviest paths
+    heaviest_paths = []
+    for n, _ in neighbor_weights[:2]:
+        heaviest_paths.append(tree_heaviest_path(adjacency, weights, n, center))
+
+    path = heaviest_paths[0] + [center] + heaviest_paths[1][::-1]
+    return [nodes[i] for i in path]
+
+
+def graph_medial_axis(edges):
+    graph = nx.Graph()
+    graph.add_edges_from(edges)
+
+    # get the center of the graph
+    center = nx.center(graph)[0]
+
+    node_weights = {}
+    dfs_sum_weights(node_weights, graph, center, set())
+
+    neighbors = graph.neighbors(center)
+
+    # get the two neighbors with the highest weights
+    neighbor_weights = [(n, node_weights[n]) for n in neighbors]
+    neighbor_weights.sort(key=lambda x: x[1], reverse=True)
+
+    # get the two heaviest paths
+    heaviest_paths = []
+    for n, _ in neighbor_weights[:2]:
+        heaviest_paths.append(get_heaviest_path(graph, node_weights, n, set([center])))
+
+    return heaviest_paths[0] + [center] + heaviest_paths[1][::-1]
+
+
+def medial_axis_from_edges(edges):
+    # straight skeletons of simple polygons are trees, which have linear time
+    # algorithms for everything we need. anything else goes through networkx
+    nodes, adjacency = build_adjacency(edges)
+    if is_tree(adjacency):
+        return tree_medial_axis(nodes, adjacency)
+    return graph_medial_axis(edges)
+
+
 # create an approximation of medial axes from the input polygons
 # first, we create a skeleton of each polygon
 # then, we find the weight of each node, which is the sum of the distance to all child nodes
@@ -78,41 +235,67 @@ def get_weighted_medial_axis(polygon):
         # need to flip the coordinates for skgeom
         polygon = sg.Polygon([(y, x) for x, y, _ in geom.exterior.coords])
         # simplify the geometry to speed up the medial axis calculation
-        polygon = sg.simplify(polygon, 0.5)
+        polygon = sg.simplify(polygon, SKELETON_SIMPLIFY_TOLERANCE)
         skeleton = sg.skeleton.create_interior_straight_skeleton(polygon)
 
-        graph = nx.Graph()
-
+        edges = []
         for h in skeleton.halfedges:
             if h.is_bisector:
                 p1 = h.vertex.point
                 p2 = h.opposite.vertex.point
                 # need to re-flip the coordinates
-                graph.add_edge(
-                    (float(p1.y()), float(p1.x())), (float(p2.y()), float(p2.x()))
+                edges.append(
+                    ((float(p1.y()), float(p1.x())), (float(p2.y()), float(p2.x())))
                 )
 
-        # get the center of the graph
-        center = nx.center(graph)[0]
-
-        node_weights = {}
-        dfs_sum_weights(node_weights, graph, center, set())
+        joined_line = LineString(medial_axis_from_edges(edges))
+        return (joined_line, properties)
+    except Exception as e:
+        print(e)
+        print(f"Error processing polygon with properties: {properties}")
+        print("Skipped polygon")
+        return (None, properties)
 
-        neighbors = graph.neighbors(center)
 
-        # get the two neighbors with the highest weights
-        neighbor_weights = [(n, node_weights[n]) for n in neighbors]
-        neighbor_weights.sort(key=lambda x: x[1], reverse=True)
+def is_fast_shape(geom, fast_max_area):
+    # small, compact polygons are labeled well enough by their principal axis
+    return (
+        geom.area < fast_max_area
+        and geom.area >= FAST_MIN_SOLIDITY * geom.convex_hull.area
+    )
 
-        # get the two heaviest paths
-        heaviest_paths = []
-        for n, _ in neighbor_weights[:2]:
-            heaviest_paths.append(
-                get_heaviest_path(graph, node_weights, n, set([center]))
-            )
 
-        joined_line = LineString(heaviest_paths[0] + [center] + heaviest_paths[1][::-1])
-        return (joined_line, properties)
+# a quick label line for small polygons: the line along the polygon's longest
+# direction through its pole of inaccessibility, clipped to the polygon
+def get_principal_axis(polygon):
+    geom, properties = polygon
+    try:
+        geom = shapely.force_2d(geom)
+        center = polylabel(geom, tolerance=np.sqrt(geom.area) / 100)
+
+        # the longest direction is the main eigenvector of the vertices'
+        # covariance, pointed west to east
+        coords = np.array(geom.exterior.coords)[:-1]
+        _, vectors = np.linalg.eigh(np.cov(coords, rowvar=False))
+        direction = vectors[:, -1] if vectors[0, -1] >= 0 else -vectors[:, -1]
+
+        min_x, min_y, max_x, max_y = geom.bounds
+        length = np.hypot(max_x - min_x, max_y - min_y)
+        line = LineString(
+            [
+                (center.x - direction[0] * length, center.y - direction[1] * length),
+                (center.x + direction[0] * length, center.y + direction[1] * length),
+            ]
+        )
+
+        # keep the piece through the center, in case the line leaves and
+        # re-enters the polygon
+        pieces = [
+            piece
+            for piece in shapely.get_parts(line.intersection(geom))
+            if piece.geom_type == "LineString"
+        ]
+        return (min(pieces, key=lambda piece: piece.distance(center)), properties)
     except Exception as e:
         print(e)
         print(f"Error processing polygon with properties: {properties}")
@@ -120,7 +303,129 @@ def get_weighted_medial_axis(polygon):
         return (None, properties)
 
 
-def weighted_medial_axes_from_geojson(input_file, output_file, workers):
+class MedialAxisCache:
+    # medial axes of polygons from previous runs, keyed by a hash of the
+    # polygon, so reruns only make skeletons for polygons that changed. holds at
+    # most max_entries, dropping the least recently used ones
+    def __init__(self, cache_file, max_entries):
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir != "" and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(cache_file)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute(
+            "CREATE TABLE IF NOT EXISTS axes (key text PRIMARY KEY, line blob, last_used integer);"
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS axes_last_used ON axes (last_used);"
+        )
+        self.cursor.execute("SELECT MAX(last_used) FROM axes;")
+        self.clock = (self.cursor.fetchone()[0] or 0) + 1
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(geom, *tolerances):
+        # only the exterior's x and y are used, in any ring order or direction.
+        # tolerances are those of any simplification done before the skeleton
+        ring = shapely.normalize(Polygon([(x, y) for x, y, *_ in geom.exterior.coords]))
+        digest = hashlib.sha256(shapely.to_wkb(ring))
+        tolerances = (*tolerances, SKELETON_SIMPLIFY_TOLERANCE)
+        digest.update(f"{tolerances}:{CACHE_VERSION}".encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        # returns (found, line), line being None for polygons that failed before
+        self.cursor.execute("SELECT line FROM axes WHERE key = ?;", (key,))
+        row = self.cursor.fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.cursor.execute(
+            "UPDATE axes SET last_used = ? WHERE key = ?;", (self.clock, key)
+        )
+        return True, None if row[0] is None else shapely.from_wkb(row[0])
+
+    def put(self, key, line):
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO axes (key, line, last_used) VALUES (?, ?, ?);",
+            (key, None if line is None else shapely.to_wkb(line), self.clock),
+        )
+
+    def close(self):
+        self.cursor.execute(
+            "DELETE FROM axes WHERE key IN (SELECT key FROM axes ORDER BY last_used DESC LIMIT -1 OFFSET ?);",
+            (self.max_entries,),
+        )
+        self.connection.commit()
+        self.connection.close()
+
+
+def get_weighted_medial_axes(
+    polygons, workers, cache_file=None, max_cache_entries=None, fast_max_area=0
+):
+    # yields the (line, properties) label line of each (geom, properties)
+    # polygon, in no particular order. polygons smaller than fast_max_area that
+    # aren't too complex get their principal axis, the rest their medial axis.
+    # with a cache file, only medial axes that aren't in the cache are made
+    fast = []
+    slow = []
+    for polygon in polygons:
+        if is_fast_shape(polygon[0], fast_max_area):
+            fast.append(polygon)
+        else:
+            slow.append(polygon)
+
+    cache = None
+    missing = [(None, polygon) for polygon in slow]
+    if cache_file is not None:
+        cache = MedialAxisCache(cache_file, max_cache_entries)
+        missing = []
+        for polygon in slow:
+            key = MedialAxisCache.key(polygon[0])
+            found, line = cache.get(key)
+            if found:
+                yield (line, polygon[1])
+            else:
+                missing.append((key, polygon))
+
+    print(
+        f"Labeling {len(fast)} polygons by their principal axis, "
+        f"{len(missing)} by their medial axis"
+        + (f" and {cache.hits} from the cache" if cache is not None else "")
+        + "..."
+    )
+
+    with multiprocessing.Pool(workers) as p:
+        yield from tqdm(
+            p.imap_unordered(get_principal_axis, fast, chunksize=64), total=len(fast)
+        )
+
+        lines = p.imap(
+            get_weighted_medial_axis, (polygon for _, polygon in missing), chunksize=16
+        )
+        for (key, _), (line, properties) in tqdm(
+            zip(missing, lines), total=len(missing)
+        ):
+            if cache is not None:
+                cache.put(key, line)
+            yield (line, properties)
+
+    if cache is not None:
+        cache.close()
+
+
+def weighted_medial_axes_from_geojson(
+    input_file,
+    output_file,
+    workers,
+    cache_file=None,
+    max_cache_entries=None,
+    fast_max_area=0,
+):
     # check input exists
     if not os.path.exists(input_file):
         raise Exception(f"Cannot open {input_file}")
@@ -133,16 +438,13 @@ def weighted_medial_axes_from_geojson(input_file, output_file, workers):
     geoms, crs = load_geojson_geometries(input_file)
 
     lines = []
-    with multiprocessing.Pool(workers) as p:
-        for line, properties in tqdm(
-            p.imap_unordered(get_weighted_medial_axis, geoms), total=len(geoms)
-        ):
-            if line is None:
-                continue
-            line = geojson.Feature(geometry=line, properties=properties)
-            lines.append(line)
-        p.close()
-        p.join()
+    for line, properties in get_weighted_medial_axes(
+        geoms, workers, cache_file, max_cache_entries, fast_max_area
+    ):
+        if line is None:
+            continue
+        line = geojson.Feature(geometry=line, properties=properties)
+        lines.append(line)
 
     with open(output_file, "w") as f:
         gj = geojson.FeatureCollection(lines, crs=crs)
@@ -163,8 +465,25 @@ def weighted_medial_axes_from_geojson(input_file, output_file, workers):
     help="The output geojson",
     required=True,
 )
-def cli(workers, input_file, output_file):
-    weighted_medial_axes_from_geojson(input_file, output_file, workers)
+@click.option(
+    "--cache-file",
+    help="Reuse the medial axes of unchanged polygons from this cache",
+    default=None,
+)
+@click.option(
+    "--max-cache-entries",
+    default=1000000,
+    help="Most medial axes to keep in the cache",
+)
+@click.option(
+    "--fast-max-area",
+    default=0.0,
+    help="Compact polygons smaller than this, in square units of the input, are labeled by their principal axis instead of their medial axis",
+)
+def cli(workers, input_file, output_file, cache_file, max_cache_entries, fast_max_area):
+    weighted_medial_axes_from_geojson(
+        input_file, output_file, workers, cache_file, max_cache_entries, fast_max_area
+    )
 
 
 if __name__ == "__main__":